@@ -1,58 +1,175 @@
 import logging
+import os
+import threading
 import functions as fcs
 import datetime as dt
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 scheduler = BlockingScheduler()
 
+# training parameters - part of the artifact cache key
+SEARCH = 'off'
+# set to True to ignore cached artifacts and retrain
+REBUILD = False
+# cores used for training, -1 uses all cores
+N_JOBS = -1
+# update the saved forest with new credits instead of a daily full retrain
+INCREMENTAL = True
+# accounts in credentials.json and whether they run at the same time
+USER_IDS = range(0, 3)
+CONCURRENT = True
+# exported forests for scoring, one folder per artifact key
+FOREST_DIR = os.path.join('data', 'model', 'forest')
+# render auc and feature importance plots in a separate process after training
+DIAGNOSTICS = False
+
+def run_user(user_id, forest, fit, pipeline):
+    '''sales pipeline of one user'''
+    logger = logging.getLogger('main')
+    # name thread after user for the log
+    threading.current_thread().name = f'user-{user_id}'
+    logger.info(f'############ {user_id} ##############')
+    # errors are caught, the span records them as status error
+    with fcs.span('user', user=user_id) as user_span:
+        try:
+            # load user data for today
+            with fcs.span('save_investments', user=user_id) as s:
+                user_data = fcs.save_investments(user_id)
+                s.set(rows=len(user_data))
+
+            # prepare data for random forest
+            with fcs.span('clean_data', mode='apply', user=user_id) as s:
+                user_clean, _ = fcs.clean_data(user_data, mode='apply', pipeline=pipeline)
+                s.set(rows=len(user_clean))
+
+            # apply random forest to user data and fit it to exp default rate
+            # user_clean is sorted by date and without NaN rows, align by index
+            with fcs.span('apply_forest', user=user_id, rows=len(user_clean)):
+                prob_fitted = fcs.apply_forest(fit, forest, user_clean)
+            user_data['Prob_fitted'] = pd.Series(prob_fitted, index=user_clean.index)
+
+            # calculate adjusted interest accounting for default rate and tayrs
+            user_data['adjInt'] = fcs.calculate_adjInt(user_data)
+
+            #choose items to be sold
+            with fcs.span('pick_items', user=user_id) as s:
+                user_result= fcs.pick_items(user_data, user_id)
+                s.set(rows=len(user_result))
+
+            # check sec market for ongoing sales
+            with fcs.span('check_sales', user=user_id) as s:
+                current_sales = fcs.check_sales(user_id)
+                s.set(rows=len(current_sales))
+
+            # lower the gain of due listings and sell new items,
+            # unchanged listings are left alone
+            items = user_result[['LoanPartId']].copy()
+            with fcs.span('reconcile_sales', user=user_id, rows=len(items)):
+                fcs.reconcile_sales(user_id, current_sales, items, fcs.decay_schedule(user_id))
+        except Exception:
+            # keep other users running
+            logger.exception(f'Pipeline of user {user_id} failed')
+            user_span.set(status='error')
+            return False
+    return True
+
+
 @scheduler.scheduled_job('interval', hours=1, id='run_main', next_run_time=dt.datetime.now())
+@fcs.timed('main')
 def main():
     # init logging
     fcs.custom_logger('main')
     logger = logging.getLogger('main')
+    fcs.start_run()
+    # credentials.json may have changed since the last run
+    fcs.update_credentials(mode='reload')
+
+    with fcs.span('refresh_publicdataset'):
+        snapshot = fcs.refresh_publicdataset()
+
+    # training only changes once a day - reuse cached artifacts
+    today = dt.date.today()
+    key = fcs.artifact_key(fcs.publicdataset_fingerprint(snapshot), Search=SEARCH, date=today)
+    forest_dir = os.path.join(FOREST_DIR, key[:16])
+    with fcs.span('load_artifacts') as s:
+        artifacts = fcs.load_artifacts(key, rebuild=REBUILD)
+        s.set(hit=artifacts is not None)
+    if artifacts is not None and not fcs.forest_exists(forest_dir):
+        logger.info('No exported forest for cached artifacts - retraining')
+        artifacts = None
+    if artifacts is None:
+        # the dataset is only read to train
+        with fcs.span('read_publicdataset') as s:
+            public_raw = fcs.read_publicdataset(columns=fcs.TRAIN_COLUMNS)
+            s.set(rows=len(public_raw))
+        with fcs.span('clean_data', mode='train') as s:
+            public_clean, pipeline = fcs.clean_data(public_raw, mode='train')
+            s.set(rows=len(public_clean))
+        dates = public_raw.loc[public_clean.index, 'BiddingStartedOn']
+
+        # update saved forest with new credits if possible
+        model = fcs.load_model()
+        clf = None
+        if (INCREMENTAL and model is not None and model['pipeline'] == pipeline
+                and model['updates'] < fcs.MAX_UPDATES):
+            with fcs.span('update_forest', rows=len(public_clean)):
+                clf = fcs.update_forest(model, public_clean, dates, n_jobs=N_JOBS)
+
+        if clf is None:
+            with fcs.span('train_forest', rows=len(public_clean)):
+                clf, auc, y_score = fcs.train_forest(public_clean, Search=SEARCH, n_jobs=N_JOBS)
+            # calibrate on out-of-fold probabilities
+            with fcs.span('evaluate_default_prob', rows=len(y_score)):
+                fit = fcs.evaluate_default_prob(public_clean['Defaulted'].values, y_score)
+            model = {'auc': auc, 'updates': 0,
+                     'holdout_auc': fcs.holdout_auc(public_clean['Defaulted'].values, y_score, dates),
+                     'labels_until': dates[fcs.mature_credits(dates, dates.max())].max()}
+        else:
+            # keep calibration of the last full fit, a retrain follows
+            # after MAX_UPDATES at the latest
+            fit = model['fit']
+            auc = model['auc']
+            model['updates'] += 1
+        model.update({'clf': clf, 'fit': fit, 'pipeline': pipeline,
+                      'features': fcs.get_labels(public_clean.head(0))[2],
+                      'trained_until': dates.max()})
+        with fcs.span('save_model'):
+            fcs.save_model(model)
+
+        with fcs.span('save_artifacts'):
+            fcs.save_artifacts(key, pipeline=pipeline, auc=auc, fit=fit)
+        # the forest is only exported when it changed
+        with fcs.span('export_forest'):
+            fcs.export_forest(clf, forest_dir)
+            fcs.remove_forests(FOREST_DIR, keep=key[:16])
+        if DIAGNOSTICS:
+            fcs.render_diagnostics_async()
+    else:
+        fit, pipeline = artifacts['fit'], artifacts['pipeline']
+
+    # score users with the array export of the forest, no sklearn model
+    # is unpickled on a cache hit
+    forest = fcs.load_forest(forest_dir)
+
+    # run all users at the same time with the shared model
+    workers = len(USER_IDS) if CONCURRENT else 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_user, USER_IDS,
+                                    repeat(forest), repeat(fit), repeat(pipeline)))
+    failed = results.count(False)
+    if failed > 0:
+        logger.warning(f'{failed} of {len(results)} user pipelines failed')
+    fcs.count('users_failed', failed)
+    fcs.flush_counters()
 
-    public_raw = fcs.save_publicdataset()
-    public_clean = fcs.clean_data(public_raw, mode='train')
-
-    clf, auc  = fcs.train_forest(public_clean, Search='off')
-    fit = fcs.evaluate_default_prob(clf, public_clean)
-
-    for user_id in range(0, 3):
-        logger.info(f'############ {user_id} ##############')
-        # load user data for today
-        user_data = fcs.save_investments(user_id)
-        
-        # prepare data for random forest
-        user_clean = fcs.clean_data(user_data, mode='apply')
-        
-        # apply random forest to user data and fit it to exp default rate
-        user_data['Prob_fitted'] = fcs.apply_forest(fit, clf, user_clean)
-        
-        # calculate adjusted interest accounting for default rate and tayrs
-        user_data['adjInt'] = fcs.calculate_adjInt(user_data)
-        
-        #choose items to be sold
-        user_result= fcs.pick_items(user_data, user_id)
-        
-        # check sec market for ongoing sales
-        current_sales = fcs.check_sales(user_id)
-        
-        # adjust gain if criteria is met
-        adjusted_sales, now = fcs.adjust_gain(current_sales)
-        
-        # cancel the items that need adjustment
-        fcs.cancel_items(user_id, adjusted_sales, now)
-        
-        # add new items
-        items = user_result[['LoanPartId']].copy()
-        added_sales = fcs.add_items(adjusted_sales, items)
-        
-        # sell adjusted and new items
-        fcs.sell_items(user_id, added_sales)
-
-    # shut down logging to release filehandles
+    # write queued log records and release filehandles
     logger.info('Finished')
+    fcs.stop_logger()
     logging.shutdown()
 
 scheduler.start()
\ No newline at end of file
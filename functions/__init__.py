@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from functions.log import custom_logger
-from functions.api import (save_investments, save_publicdataset)
-from functions.dataprep import (load_data, clean_data)
-from functions.rndforest import (train_forest, evaluate_default_prob, apply_forest, calculate_adjInt)
+from functions.log import custom_logger, stop_logger
+from functions.metrics import span, timed, count, start_run, flush_counters
+from functions.api import (save_investments, save_publicdataset, refresh_publicdataset,
+                           read_publicdataset, publicdataset_files, publicdataset_fingerprint,
+                           update_credentials)
+from functions.cache import (artifact_key, load_artifacts, save_artifacts, evict_cache)
+from functions.dataprep import (load_data, clean_data, fit_pipeline, encode_features, FEATURE_COLUMNS, TRAIN_COLUMNS)
+from functions.rndforest import (train_forest, evaluate_default_prob, apply_forest, calculate_adjInt,
+                                 update_forest, load_model, save_model, get_labels, MAX_UPDATES,
+                                 holdout_auc, mature_credits)
+from functions.inference import (export_forest, forest_exists, remove_forests, load_forest,
+                                 predict_default_prob)
 from functions.evaluate import pick_items
-from functions.salesmgr import (check_sales, adjust_gain, cancel_items, add_items, sell_items)
+from functions.salesmgr import (check_sales, decay_schedule, adjust_gain, load_ledger, update_ledger,
+                                plan_sales, reconcile_sales)
 
-from functions.analyse import plot_confusion_matrix, area_under_roc, feature_imp
\ No newline at end of file
+from functions.analyse import (plot_confusion_matrix, area_under_roc, feature_imp, save_diagnostics,
+                               render_diagnostics, render_diagnostics_async)
\ No newline at end of file
@@ -1,32 +1,51 @@
 # -*- coding: utf-8 -*-
-'''Custom function to analyse classification performance'''
+'''Custom function to analyse classification performance
+
+Training only saves the metrics as json and npz. Plots are rendered on
+demand with render_diagnostics, matplotlib is imported there and not
+on the hourly run:
+
+    python -m functions.analyse
+'''
+
+import json
+import logging
+import multiprocessing
+import os
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 from sklearn.metrics import confusion_matrix
 from sklearn.metrics import roc_curve, auc
 from sklearn.utils.multiclass import unique_labels
 
-plt.ioff()
+logger = logging.getLogger('main')
+
+DIAG_DIR = os.path.join('data', 'model', 'diagnostics')
 
 SMALL_SIZE = 8
 MEDIUM_SIZE = 10
 BIGGER_SIZE = 12
 
-plt.rc('font', size=SMALL_SIZE)          # controls default text sizes
-plt.rc('axes', titlesize=SMALL_SIZE)     # fontsize of the axes title
-plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
-plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
-plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
+def get_pyplot():
+    '''import matplotlib on first use'''
+    import matplotlib.pyplot as plt
+
+    plt.ioff()
+    plt.rc('font', size=SMALL_SIZE)          # controls default text sizes
+    plt.rc('axes', titlesize=SMALL_SIZE)     # fontsize of the axes title
+    plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
+    plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
+    plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
+    return plt
 
 def plot_confusion_matrix(y_true, y_pred, classes,
                           normalize=True,
                           title=None,
-                          cmap=plt.cm.Blues):
+                          cmap='Blues'):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
@@ -49,6 +68,7 @@ def plot_confusion_matrix(y_true, y_pred, classes,
 
     print(cm)
 
+    plt = get_pyplot()
     fig, ax = plt.subplots()
     im = ax.imshow(cm, interpolation='nearest', cmap=cmap)
     ax.figure.colorbar(im, ax=ax)
@@ -76,20 +96,52 @@ def plot_confusion_matrix(y_true, y_pred, classes,
     fig.tight_layout()
     return ax
 
-def area_under_roc(X, y, clf, plot='no'):
+def area_under_roc(y, y_score):
+    '''auc and accuracy of the predicted probabilities y_score'''
 
-    # overall accuracy
-    acc = clf.score(X,y)
+    # overall accuracy, predict_proba picks the class above 0.5
+    acc = np.mean((y_score > 0.5) == y)
     
     # get roc/auc info
-    y_score = clf.predict_proba(X)[:,1]
-    fpr = dict()
-    tpr = dict()
     fpr, tpr, _ = roc_curve(y, y_score)
-    
-    roc_auc = dict()
     roc_auc = auc(fpr, tpr)
+    logger.info(f'AUC: {roc_auc:.3f} | Accuracy: {acc:.3f}')
     
+    return roc_auc, acc, fpr, tpr
+
+def feature_imp(feat_list, clf):
+    '''feature importance of clf sorted descending'''
+    feat_imp = pd.Series(clf.feature_importances_, index=feat_list)
+    return feat_imp.sort_values(ascending=False)
+
+def save_diagnostics(y, y_score, feat_list, clf, dir_name=DIAG_DIR):
+    '''save metrics of a training for render_diagnostics'''
+    roc_auc, acc, fpr, tpr = area_under_roc(y, y_score)
+    feat_imp = feature_imp(feat_list, clf)
+
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    filepath = os.path.join(dir_name, 'roc.npz')
+    # np.savez adds the suffix to the temporary file
+    np.savez(f'{filepath}.tmp', fpr=fpr, tpr=tpr)
+    os.replace(f'{filepath}.tmp.npz', filepath)
+
+    metrics = {'auc': roc_auc,
+               'accuracy': acc,
+               'feature_importance': feat_imp.to_dict()}
+    filepath = os.path.join(dir_name, 'metrics.json')
+    with open(f'{filepath}.tmp', 'w') as f:
+        json.dump(metrics, f, indent=4)
+    os.replace(f'{filepath}.tmp', filepath)
+    return roc_auc
+
+def render_diagnostics(dir_name=DIAG_DIR, show=False):
+    '''plot saved metrics to auc.png, feat_imp.png and feat_imp_lowest.png'''
+    plt = get_pyplot()
+    with open(os.path.join(dir_name, 'metrics.json'), 'r') as f:
+        metrics = json.load(f)
+    roc = np.load(os.path.join(dir_name, 'roc.npz'))
+
     #make the plot
     fig = plt.figure(figsize=(10,10))
     plt.plot([0, 1], [0, 1], 'k--')
@@ -98,25 +150,34 @@ def area_under_roc(X, y, clf, plot='no'):
     plt.xlabel('False Positive Rate')
     plt.ylabel('True Positive Rate')
     plt.grid(True)
-    plt.plot(fpr, tpr, label=f'AUC = {roc_auc:.2f}')        
+    plt.plot(roc['fpr'], roc['tpr'], label=f"AUC = {metrics['auc']:.2f}")
     plt.legend(loc="lower right", shadow=True, fancybox =True)
-    if plot=='yes':
+    if show:
         plt.show()
-    plt.savefig('auc.png')
+    plt.savefig(os.path.join(dir_name, 'auc.png'))
     plt.close(fig)
-    
-    return roc_auc
 
-def feature_imp(feat_list, clf):
+    feat_imp = pd.Series(metrics['feature_importance'])
 
     fig = plt.figure(figsize=(15, 20))
-    feat_imp = pd.Series(clf.feature_importances_, index=feat_list)
     feat_imp.nlargest(30).plot(kind='barh')
-    plt.savefig('feat_imp.png')
+    plt.savefig(os.path.join(dir_name, 'feat_imp.png'))
     plt.close(fig)
 
     fig = plt.figure(figsize=(15, 20))
-    feat_imp = pd.Series(clf.feature_importances_, index=feat_list)
     feat_imp.nsmallest(10).plot(kind='barh')
-    plt.savefig('feat_imp_lowest.png')
-    plt.close(fig)
\ No newline at end of file
+    plt.savefig(os.path.join(dir_name, 'feat_imp_lowest.png'))
+    plt.close(fig)
+    return None
+
+def render_diagnostics_async(dir_name=DIAG_DIR):
+    '''render diagnostics in a separate process'''
+    process = multiprocessing.Process(target=render_diagnostics, args=(dir_name,),
+                                      name='diagnostics')
+    process.start()
+    logger.debug(f'Rendering diagnostics in process {process.pid}')
+    return process
+
+
+if __name__ == '__main__':
+    render_diagnostics()
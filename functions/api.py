@@ -2,29 +2,60 @@
 # pylint: disable=E1101, W1203
 """Makes requests to the Bondora API"""
 
+import glob
+import hashlib
 import logging
 import math
-import time
 import datetime as dt
 import os
 import json
+import threading
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from functions import throttle
+from functions.metrics import span, count
+from functions.loanindex import build_index, lookup_loans
+from functions.schema import DTYPES, apply_schema, memory_report
 
 # default parameters for all requests
-TIMEOUT = 30
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+# connections kept alive per session and retries of failed connects
+POOL_SIZE = 4
+RETRIES = 2
 URLBASE = 'https://api.bondora.com/api/v1/'
 PAGESIZE = 10_000
 WAIT = 3660
 
+# rejected credits are not offered again for this time
+UNSELLABLE_HOURS = 24
+
+# chunk size for streaming downloads
+CHUNK_SIZE = 1024 * 1024
+# share of changed loans above which a new base snapshot is saved
+REBASE_FRACTION = 0.25
+# compact dtypes while parsing, flags are converted afterwards
+PARSE_DTYPES = {col: dtype for col, dtype in DTYPES.items() if dtype != 'bool'}
+
 # logging
 logger = logging.getLogger('main')
 
+# credentials are read once and kept in memory
+_credentials = None
+
 ##############################################################################
 def update_credentials(mode="load", credentials=[]):
     'load or save credentials'
+    global _credentials
     # load credentials
     if __name__ == '__main__':
         filepath = os.path.join(os.pardir,'data','credentials.json')
@@ -32,14 +63,57 @@ def update_credentials(mode="load", credentials=[]):
         filepath = os.path.join('data','credentials.json')
 
     if mode == 'load':
-        with open(filepath, 'r') as f:
-            credentials = json.load(f)
-        return credentials
+        if _credentials is None:
+            with open(filepath, 'r') as f:
+                _credentials = json.load(f)
+        return _credentials
+    elif mode == 'reload':
+        # sessions keep the token of the old credentials
+        _credentials = None
+        close_sessions()
+        return update_credentials(mode='load')
     elif mode == 'save':
         with open(filepath, 'w') as f:
             json.dump(credentials, f, indent=4, sort_keys=True)
+        _credentials = credentials
     return None
     
+# pooled sessions per user, None is used for public downloads
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+##############################################################################
+def get_session(user_id=None):
+    '''pooled session with keep-alive and compression for user'''
+    with _sessions_lock:
+        if user_id not in _sessions:
+            session = requests.Session()
+            # retries only failed connects, requests are not sent twice and
+            # 429/503 reach handle_request instead of sleeping in urllib3
+            retry = Retry(total=RETRIES, connect=RETRIES, read=0, status=0,
+                          respect_retry_after_header=False)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept': 'application/json',
+                                    'Accept-Encoding': 'gzip, deflate'})
+            if user_id is not None:
+                user = update_credentials(mode='load')[user_id]
+                session.headers.update({'Authorization': f"Bearer {user['token']}"})
+            _sessions[user_id] = session
+    return _sessions[user_id]
+
+##############################################################################
+def close_sessions():
+    '''close all pooled sessions, they are created again on the next request'''
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    return None
+
 ##############################################################################
 def handle_request(r):
     '''evaluate and log response status code'''
@@ -65,55 +139,38 @@ def bondora_request(user_id, req_type, req_name, params=[], wait_time=WAIT):
     credentials = update_credentials(mode='load')
     user = credentials[user_id]
 
-    # check when req_name was called the last time
-    now = dt.datetime.now()
+    # wait for the throttle of req_name - times saved in credentials.json
+    # by older versions are used as fallback
     try:
         next_request = user[f'{req_name}']
         next_request = dt.datetime.strptime(next_request, user['time_fmt'])
     except:
-        next_request = now
-
-    # check throttling for request name
-    if now < next_request:
-        delta = next_request - now
-        delta = delta.seconds
-        logger.debug(f"Next {req_type}: {req_name} for {user['name']} in {delta}s")
-        while delta > 0:
-            dif = min(60, delta)
-            time.sleep(dif)
-            delta = delta - dif
-            logger.debug(f'{delta}s remaining')
-
-    # Authorization
-    auth = {'Authorization': f"Bearer {user['token']}"}
+        next_request = None
+    with span('throttle', endpoint=req_name, user=user_id):
+        throttle.acquire(user_id, req_name, wait_time, default=next_request)
+
+    # pooled session of user includes authorization
+    session = get_session(user_id)
     url = URLBASE + req_name    
 
     logger.debug(f"{req_type}: {req_name} for User: {user['name']}")
 
-    if req_type == 'GET':
-        r = requests.get(url,
-                         headers=auth,
-                         params=params,
-                         timeout=TIMEOUT)
-   
-    elif req_type == 'POST':
-        r = requests.post(url,
-                          headers=auth,
-                          json=params,
-                          timeout=TIMEOUT)
+    with span('request', endpoint=req_name, method=req_type, user=user_id) as s:
+        if req_type == 'GET':
+            r = session.get(url,
+                            params=params,
+                            timeout=TIMEOUT)
+       
+        elif req_type == 'POST':
+            r = session.post(url,
+                             json=params,
+                             timeout=TIMEOUT)
+        s.set(code=r.status_code, bytes=len(r.content))
+    count('requests', endpoint=req_name, code=r.status_code)
 
     # check request
     handle_request(r)
     
-    # prepare next request time
-    next_request = now + dt.timedelta(seconds=wait_time)
-    next_request = dt.datetime.strftime(next_request, user['time_fmt'])
-    request_update = {f'{req_name}': next_request}
-    
-    # update credentials and save
-    credentials[user_id].update(request_update)
-    update_credentials(mode='save', credentials=credentials)
-    
     return r, credentials
 
         
@@ -130,72 +187,163 @@ def get_balance(user_id):
     
     return payload
 
-##############################################################################    
+##############################################################################
+def get_page(user_id, req_name, params, wait_time):
+    '''GET Request - one page of a paged request
+    returns payload and total count of items'''
+    r, credentials = bondora_request(user_id=user_id,
+                                     req_type='GET',
+                                     req_name=req_name,
+                                     params=params,
+                                     wait_time=wait_time)
+    # extract payload from json to dict
+    response = json.loads(r.text)
+    payload = pd.DataFrame.from_dict(response['Payload'])
+    return payload, response['TotalCount']
+
+##############################################################################
+def iter_pages(user_id, req_name, params, page_size, wait_time):
+    '''GET Request - yields every page of a paged request
+    the next page is requested while the current page is processed,
+    the throttle of req_name still applies'''
+    page_nr = 1
+    parameters = dict(params, PageSize=page_size, PageNr=page_nr)
+    prefix = threading.current_thread().name
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix=prefix) as executor:
+        future = executor.submit(get_page, user_id, req_name, parameters, wait_time)
+        while future is not None:
+            payload, total = future.result()
+            max_page = max(1, math.ceil(total/page_size))
+            logger.info(f'Received {req_name} Page {page_nr} of {max_page}')
+
+            # prefetch next page
+            future = None
+            if page_nr < max_page:
+                parameters = dict(params, PageSize=page_size, PageNr=page_nr+1)
+                future = executor.submit(get_page, user_id, req_name,
+                                         parameters, wait_time)
+            yield payload
+            page_nr += 1
+
+##############################################################################
+def get_pages(user_id, req_name, params, page_size, wait_time):
+    '''GET Request - all pages of a paged request concatenated once'''
+    pages = list(iter_pages(user_id, req_name, params, page_size, wait_time))
+    return pd.concat(pages, ignore_index=True, sort=False)
+
+##############################################################################
 def get_secondarymarket(user_id):
     '''GET Request - Secondary market items'''
     
     page_size = 20_000
-    page_nr = 1
     
-    parameters = {'ShowMyItems': True,
-                  'PageSize': page_size,
-                  'PageNr': page_nr}
+    parameters = {'ShowMyItems': True}
 
-    r, credentials = bondora_request(user_id=user_id,
-                                              req_type='GET',
-                                              req_name='secondarymarket',
-                                              params=parameters,
-                                              wait_time=750)
-    # extract payload from json to dict
-    payload = json.loads(r.text)['Payload']    
-    payload = pd.DataFrame.from_dict(payload)
-    count = json.loads(r.text)['TotalCount']            
-    max_page = math.ceil(count/page_size)
-    logger.info(f'Received Secondary Market Page {page_nr} of {max_page}')
+    payload = get_pages(user_id=user_id,
+                        req_name='secondarymarket',
+                        params=parameters,
+                        page_size=page_size,
+                        wait_time=750)
     
-    return payload, max_page
+    return payload
 
 ##############################################################################
 def post_sellitems(user_id, items):
-    '''POST Request - Sell items on secondary market'''
-     
-    parameters = {'Items': items,
-                  'CancelItemOnPaymentReceived': True,
-                  'CancelItemOnReschedule': True}
-    
-    r, credentials = bondora_request(user_id=user_id,
-                                     req_type='POST',
-                                     req_name='secondarymarket/sell',
-                                     params=parameters,
-                                     wait_time=1)
-     
-    # iterate over batch and remove single items if item can not be sold
-    i = 0
-    while i < 99 and r.status_code == 409:
-        response = json.loads(r.text)
-        missing_item = response['Errors'][0]['Details']
-        items = pd.DataFrame.from_dict(items)
-        new_items = items[items['LoanPartId']!=missing_item]
-        items = new_items.to_dict(orient='records')
-        
-        parameters = {'Items': items,
+    '''POST Request - Sell items on secondary market
+
+    all items named in the errors of a 409 are removed at once, if no item
+    is named the batch is split in halves until the failing items are found
+    returns the LoanPartIds that can not be sold and those of batches that
+    were not sent because of 429 or server errors'''
+    pending = [items]
+    unsellable = []
+    unsent = []
+    listed = 0
+    requests_made = 0
+    while pending:
+        batch = pending.pop()
+        if not batch:
+            continue
+        parameters = {'Items': batch,
                       'CancelItemOnPaymentReceived': True,
                       'CancelItemOnReschedule': True}
-        
         r, credentials = bondora_request(user_id=user_id,
                                          req_type='POST',
                                          req_name='secondarymarket/sell',
                                          params=parameters,
                                          wait_time=1)
-        i += 1
-    if i > 0:
-        logger.debug(f'{i} credits could not be sold')
-    
-    if r.status_code == 202:
-        logger.info(f'Sold {len(items)}/{len(items)+i} credits')
-    else:
-        logger.warning(f'Batch was not sold')
-        logger.debug(f'{parameters}')
+        requests_made += 1
+
+        if r.status_code == 202:
+            listed += len(batch)
+        elif r.status_code == 409:
+            part_ids = [item['LoanPartId'] for item in batch]
+            rejected = [part_id for part_id in rejected_items(r) if part_id in part_ids]
+            if rejected:
+                # retry the rest of the batch without the rejected items
+                unsellable += rejected
+                pending.append([item for item in batch
+                                if item['LoanPartId'] not in rejected])
+            elif len(batch) == 1:
+                unsellable += part_ids
+            else:
+                half = len(batch) // 2
+                pending += [batch[half:], batch[:half]]
+        else:
+            # 429 or server errors - the batch is tried again next run
+            logger.warning(f'Batch of {len(batch)} credits was not sold')
+            logger.debug(f'{parameters}')
+            unsent += [item['LoanPartId'] for item in batch]
+
+    if unsellable:
+        logger.debug(f'{len(unsellable)} credits could not be sold')
+        count('items_unsellable', len(unsellable), user=user_id)
+        mark_unsellable(user_id, unsellable)
+    logger.info(f'Sold {listed}/{len(items)} credits in {requests_made} requests')
+    count('items_listed', listed, user=user_id)
+    return unsellable, unsent
+
+##############################################################################
+def rejected_items(r):
+    '''LoanPartIds named in the errors of a response'''
+    try:
+        errors = json.loads(r.text).get('Errors') or []
+    except ValueError:
+        return []
+    return [error.get('Details') for error in errors if error.get('Details')]
+
+##############################################################################
+def unsellable_filepath(user_id):
+    '''file of the unsellable credits of user'''
+    user = update_credentials(mode='load')[user_id]
+    return os.path.join('data', user['name'], 'unsellable.json')
+
+##############################################################################
+def load_unsellable(user_id):
+    '''LoanPartIds that were rejected within the last UNSELLABLE_HOURS'''
+    filepath = unsellable_filepath(user_id)
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath, 'r') as f:
+        unsellable = json.load(f)
+    limit = dt.datetime.now() - dt.timedelta(hours=UNSELLABLE_HOURS)
+    return {part_id: marked for part_id, marked in unsellable.items()
+            if dt.datetime.strptime(marked, throttle.TIME_FMT) > limit}
+
+##############################################################################
+def mark_unsellable(user_id, part_ids):
+    '''remember rejected LoanPartIds, expired entries are dropped'''
+    unsellable = load_unsellable(user_id)
+    now = dt.datetime.now().strftime(throttle.TIME_FMT)
+    unsellable.update({part_id: now for part_id in part_ids})
+
+    filepath = unsellable_filepath(user_id)
+    dir_name = os.path.dirname(filepath)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(f'{filepath}.tmp', 'w') as f:
+        json.dump(unsellable, f, indent=4, sort_keys=True)
+    os.replace(f'{filepath}.tmp', filepath)
     return None
 
 ##############################################################################
@@ -210,10 +358,11 @@ def post_cancelitem(user_id, items):
                                       wait_time=1)
     
     logger.info(f'Canceled {len(items)} credits')
+    count('items_canceled', len(items), user=user_id)
     return None
 
 ##############################################################################
-def get_investments(user_id, page_number=1):
+def get_investments(user_id):
     '''Gets list of investments for user
 
     Sales Status
@@ -227,26 +376,19 @@ def get_investments(user_id, page_number=1):
     sales_status = 3
     page_size = 50_000
     
-    parameters = {'SalesStatus': sales_status,
-                  'PageSize': page_size,
-                  'PageNr': page_number}
+    parameters = {'SalesStatus': sales_status}
     
     # remove SalesStatus if unused
     if sales_status == 'Null':
         del parameters['SalesStatus']
     
-    r, credentials = bondora_request(user_id=user_id,
-                                              req_type='GET',
-                                              req_name='account/investments',
-                                              wait_time=760)
-    # extract payload from json to dict
-    payload = json.loads(r.text)['Payload']
-    payload = pd.DataFrame.from_dict(payload)
-    count = json.loads(r.text)['TotalCount']
-    max_page = math.ceil(count/page_size)
-    logger.info(f'Received Investments Page 1 of {max_page}')
+    payload = get_pages(user_id=user_id,
+                        req_name='account/investments',
+                        params=parameters,
+                        page_size=page_size,
+                        wait_time=760)
     
-    return payload, max_page
+    return payload
 
 ##############################################################################
 def save_investments(user_id):
@@ -279,24 +421,15 @@ def save_investments(user_id):
 #        return investments
 
     # get investments list
-    investments, max_page = get_investments(user_id, 1)
-    
-
-    # get remaining investments pages if maxPage is greater 1
-    if max_page > 1:
-        for page in range(2, max_page+1):
-            next_investments, _ = get_investments(user_id, page)
-            investments = pd.concat([investments, next_investments])
+    investments = get_investments(user_id)
 
     # search for todays public dataset
-    if __name__ == '__main__':
-        search_file = os.path.join(os.pardir, 'data', 'general', filename)
-    else:
-        search_file = os.path.join('data', 'general', filename)
+    meta = snapshot_meta()
 
-    if os.path.isfile(search_file):
-        # load dataset
-        dataset = pd.read_csv(search_file, low_memory=False)
+    if meta.get('date') == today:
+        # look up public data of the users loans only
+        investments['LoanId'] = investments['LoanId'].str.lower()
+        dataset = lookup_loans(investments['LoanId'], publicdataset_dir(), meta['index'])
         # get unique columns from investments
         add_col = investments.columns.difference(dataset.columns)
         add_col = add_col.insert(0, 'LoanId')
@@ -318,15 +451,226 @@ def save_investments(user_id):
 
 
 ##############################################################################
-def save_publicdataset():   
-    # define saving location
+def download_file(url, filepath, chunk_size=CHUNK_SIZE, etag=None, last_modified=None):
+    '''stream url to filepath in chunks
+    partial downloads are resumed if the server still has the same file,
+    with etag or last_modified nothing is downloaded if the file is unchanged
+    returns the validators of the file or None if it was not modified'''
+    part_filepath = f'{filepath}.part'
+    meta_filepath = f'{filepath}.part.json'
+
+    # conditional request - the server answers 304 if unchanged
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    # resume partial download - If-Range makes the server send the full
+    # file again if it changed in the meantime
+    if os.path.isfile(part_filepath) and os.path.isfile(meta_filepath):
+        with open(meta_filepath, 'r') as f:
+            validator = json.load(f)['validator']
+        offset = os.path.getsize(part_filepath)
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+    with get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 416:
+            # partial file does not match the server - start from scratch
+            os.remove(part_filepath)
+            os.remove(meta_filepath)
+            return download_file(url, filepath, chunk_size, etag, last_modified)
+        if r.status_code == 304:
+            logger.info('Download not modified')
+            return None
+        r.raise_for_status()
+        if r.status_code == 206:
+            mode = 'ab'
+            logger.info(f'Resuming download at {offset/1024**2:.1f} MB')
+        else:
+            offset = 0
+            mode = 'wb'
+        length = r.headers.get('Content-Length')
+        expected = offset + int(length) if length is not None else None
+
+        # remember validator to allow resuming this download
+        validators = {'etag': r.headers.get('ETag'),
+                      'last_modified': r.headers.get('Last-Modified')}
+        validator = validators['etag'] or validators['last_modified']
+        if validator is not None:
+            with open(meta_filepath, 'w') as f:
+                json.dump({'validator': validator}, f)
+
+        with open(part_filepath, mode) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    # validate size of the download
+    size = os.path.getsize(part_filepath)
+    if expected is not None and size != expected:
+        raise IOError(f'Incomplete download: {size} of {expected} bytes')
+    logger.info(f'Downloaded {size/1024**2:.1f} MB')
+
+    os.replace(part_filepath, filepath)
+    if os.path.isfile(meta_filepath):
+        os.remove(meta_filepath)
+    return validators
+
+##############################################################################
+def publicdataset_dir():
+    '''directory of the public dataset'''
     if __name__ == '__main__':
-        dir_name = os.path.join(os.pardir, 'data', 'general')
+        return os.path.join(os.pardir, 'data', 'general')
+    return os.path.join('data', 'general')
+
+##############################################################################
+def snapshot_meta():
+    '''load description of the current public dataset snapshot'''
+    filepath = os.path.join(publicdataset_dir(), 'snapshot.json')
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+##############################################################################
+def save_snapshot_meta(meta):
+    '''save description of the snapshot atomically'''
+    filepath = os.path.join(publicdataset_dir(), 'snapshot.json')
+    with open(f'{filepath}.tmp', 'w') as f:
+        json.dump(meta, f, indent=4, sort_keys=True)
+    os.replace(f'{filepath}.tmp', filepath)
+    return None
+
+##############################################################################
+def publicdataset_files():
+    '''paths of the files that make up the current public dataset'''
+    meta = snapshot_meta()
+    filenames = [meta.get('base'), meta.get('delta')]
+    return [os.path.join(publicdataset_dir(), filename)
+            for filename in filenames if filename is not None]
+
+##############################################################################
+def update_snapshot(data_raw, meta, today=None):
+    '''save data_raw as delta of changed loans on top of the base snapshot
+    a new base is written if the delta grows above REBASE_FRACTION'''
+    dir_name = publicdataset_dir()
+    if today is None:
+        today = dt.datetime.now().strftime('%Y_%m_%d')
+    columns = list(data_raw.columns)
+
+    # hash of every row, the row includes LoanId so the hash identifies
+    # the loan and its content
+    row_hash = pd.util.hash_pandas_object(data_raw, index=False).values
+    # content of the whole dataset for the artifact cache key
+    content = hashlib.sha256(row_hash.tobytes())
+    content.update(json.dumps(columns).encode())
+    meta['content'] = content.hexdigest()
+
+    rebase = meta.get('base') is None or meta.get('columns') != columns
+    if not rebase:
+        base_hash = pd.read_parquet(os.path.join(dir_name, meta['base_hash']))
+        changed = ~np.isin(row_hash, base_hash['RowHash'].values)
+        delta = data_raw[changed]
+        removed = base_hash.loc[~base_hash['LoanId'].isin(data_raw['LoanId']), 'LoanId']
+        churn = len(delta) + len(removed)
+        logger.info(f'{len(delta)} changed and {len(removed)} removed loans')
+        rebase = churn > REBASE_FRACTION * len(data_raw)
+
+    old_files = publicdataset_files()
+    if rebase:
+        # full snapshot as new base
+        data_raw.to_parquet(os.path.join(dir_name, f'{today}.base.parquet'), index=False)
+        base_hash = pd.DataFrame({'LoanId': data_raw['LoanId'].values,
+                                  'RowHash': row_hash})
+        base_hash.to_parquet(os.path.join(dir_name, f'{today}.base_hash.parquet'), index=False)
+        if meta.get('base_hash') is not None:
+            old_files.append(os.path.join(dir_name, meta['base_hash']))
+        meta.update({'base': f'{today}.base.parquet',
+                     'base_hash': f'{today}.base_hash.parquet',
+                     'columns': columns,
+                     'delta': None,
+                     'removed': []})
+        logger.info('Public Dataset saved as new base')
     else:
-        dir_name = os.path.join('data', 'general')
-        
+        delta.to_parquet(os.path.join(dir_name, f'{today}.delta.parquet'), index=False)
+        meta.update({'delta': f'{today}.delta.parquet',
+                     'removed': removed.tolist()})
+        logger.info('Public Dataset saved as delta')
+
+    # remove files that are no longer part of the snapshot once the new
+    # description is saved
+    save_snapshot_meta(meta)
+    # a rebase on the day of the old base writes files of the same name
+    current = publicdataset_files() + [os.path.join(dir_name, meta['base_hash'])]
+    for filepath in old_files:
+        if filepath not in current and os.path.isfile(filepath):
+            os.remove(filepath)
+    return meta
+
+##############################################################################
+def index_columns():
+    '''columns of the LoanId index - the features of the random forest,
+    the other columns of the investments come from the API'''
+    # dataprep imports api
+    from functions.dataprep import FEATURE_COLUMNS
+    return ['LoanId'] + FEATURE_COLUMNS
+
+##############################################################################
+def update_index(data_raw, meta):
+    '''save LoanId index for the lookup of user investments'''
+    dir_name = publicdataset_dir()
     today = dt.datetime.now().strftime('%Y_%m_%d')
-    filepath = os.path.join(dir_name, f'{today}.csv')
+
+    columns = [col for col in index_columns() if col in data_raw.columns]
+    build_index(data_raw[columns], dir_name, f'{today}.index')
+    meta['index'] = f'{today}.index'
+    save_snapshot_meta(meta)
+
+    # remove older and unfinished index files
+    for filepath in glob.glob(os.path.join(dir_name, '*.index.*')):
+        if not os.path.basename(filepath) in [f'{today}.index.arrow', f'{today}.index.npy']:
+            os.remove(filepath)
+    return meta
+
+##############################################################################
+def read_publicdataset(columns=None):
+    '''read current public dataset - base snapshot with delta applied
+    only columns are loaded if given'''
+    meta = snapshot_meta()
+    dir_name = publicdataset_dir()
+
+    read_columns = columns
+    if columns is not None and 'LoanId' not in columns:
+        read_columns = ['LoanId'] + list(columns)
+
+    data_raw = pd.read_parquet(os.path.join(dir_name, meta['base']), columns=read_columns)
+    if meta.get('delta') is not None:
+        delta = pd.read_parquet(os.path.join(dir_name, meta['delta']), columns=read_columns)
+        # replace changed and drop removed loans
+        replaced = (data_raw['LoanId'].isin(delta['LoanId'])
+                    | data_raw['LoanId'].isin(meta['removed']))
+        data_raw = pd.concat([data_raw[~replaced], delta], ignore_index=True, sort=False)
+
+    if read_columns is not columns:
+        data_raw = data_raw.drop(columns='LoanId')
+    # concat of different categories falls back to object
+    data_raw = apply_schema(data_raw)
+    memory_report(data_raw, 'public dataset')
+    return data_raw
+
+##############################################################################
+def save_publicdataset(columns=None):
+    '''download public dataset and save changes since the last download
+    only columns are loaded if given'''
+    refresh_publicdataset()
+    return read_publicdataset(columns=columns)
+
+##############################################################################
+def refresh_publicdataset():
+    '''download public dataset once a day and save changes since the last
+    download, returns the description of the snapshot'''
+    # define saving location
+    dir_name = publicdataset_dir()
     
     # check if directories exist if not create it
     if not os.path.exists(dir_name):
@@ -334,11 +678,12 @@ def save_publicdataset():
         logger.info(f'Directory was created: {dir_name}')
 
     # check if there is already a dataset for today
-    if not os.path.isfile(filepath):
+    meta = snapshot_meta()
+    today = dt.datetime.now().strftime('%Y_%m_%d')
+    if meta.get('date') != today:
         # define directory and temporary filenames
         dir_name = 'tmp'
         filepath_zip = os.path.join(dir_name, 'LoanData.zip')
-        filepath_csv = os.path.join(dir_name, 'LoanData.csv')
         # check if directories exist if not create it
         if not os.path.exists(dir_name):
             os.makedirs(dir_name)
@@ -346,35 +691,75 @@ def save_publicdataset():
         
         logger.info(f'Downloading Dataset')
         url = 'https://www.bondora.com/marketing/media/LoanData.zip'
-        r = requests.get(url)
-    
-        with open('tmp/LoanData.zip', 'wb') as f:  
-            f.write(r.content)
+        with span('download') as s:
+            if meta.get('base') is not None:
+                validators = download_file(url, filepath_zip,
+                                           etag=meta.get('etag'),
+                                           last_modified=meta.get('last_modified'))
+            else:
+                validators = download_file(url, filepath_zip)
+            s.set(modified=validators is not None)
         
-        with zipfile.ZipFile(filepath_zip, 'r') as zip_ref:
-            zip_ref.extractall(dir_name)
-        
-        data_raw = pd.read_csv(filepath_csv, low_memory=False)
-        # clean up csv
-        data_raw = data_raw.reindex(sorted(data_raw.columns), axis=1)
-        data_raw.LoanId = data_raw.LoanId.str.lower()
-        data_raw.BiddingStartedOn = pd.to_datetime(data_raw.BiddingStartedOn).dt.strftime('%Y-%m-%dT%H:%M:%S')
-        
-        try:
-           data_raw = data_raw.rename(index=str,
-                                      columns={"PreviousEarlyRepaymentsBefoleLoan": "PreviousEarlyRepaymentsBeforeLoan"})
-        except:
-            logger.warning('Something changed')
-        
-        # save dataset to csv file with today as filename
-        data_raw.to_csv(filepath, encoding='utf-8', index=False)
-        logger.info(f'Public Dataset saved')
+        if validators is None:
+            logger.info('Public Dataset unchanged since last download')
+        else:
+            # parse csv directly from the zip member, the crc is checked by
+            # zipfile once the member has been read completely
+            try:
+                with span('parse') as s, zipfile.ZipFile(filepath_zip, 'r') as zip_ref:
+                    with zip_ref.open('LoanData.csv') as f:
+                        data_raw = pd.read_csv(f, low_memory=False, dtype=PARSE_DTYPES)
+                    s.set(rows=len(data_raw))
+            except zipfile.BadZipFile:
+                logger.error('Downloaded LoanData.zip is corrupt - removed')
+                os.remove(filepath_zip)
+                raise
+            os.remove(filepath_zip)
+            # clean up csv
+            data_raw = data_raw.reindex(sorted(data_raw.columns), axis=1)
+            data_raw.LoanId = data_raw.LoanId.str.lower()
+            data_raw.BiddingStartedOn = pd.to_datetime(data_raw.BiddingStartedOn)
+            
+            try:
+               data_raw = data_raw.rename(index=str,
+                                          columns={"PreviousEarlyRepaymentsBefoleLoan": "PreviousEarlyRepaymentsBeforeLoan"})
+            except:
+                logger.warning('Something changed')
+            data_raw = apply_schema(data_raw)
+            memory_report(data_raw, 'downloaded dataset')
+            
+            # save typed dataset as delta to the base snapshot
+            with span('update_snapshot', rows=len(data_raw)):
+                meta = update_snapshot(data_raw, meta)
+            meta.update(validators)
+
+            with span('update_index', rows=len(data_raw)):
+                meta = update_index(data_raw, meta)
+            del data_raw
+
+        if meta.get('index') is None:
+            meta = update_index(read_publicdataset(columns=index_columns()), meta)
+
+        meta['date'] = today
+        save_snapshot_meta(meta)
     else:
         logger.info('Public Dataset already exists for today')            
 
-    data_raw = pd.read_csv(filepath, low_memory=False)
+    return meta
 
-    return data_raw
+##############################################################################
+def publicdataset_fingerprint(meta):
+    '''hash of the content of the snapshot described by meta
+    snapshots saved before the hash was kept are hashed once from disk'''
+    if meta.get('content') is None:
+        digest = hashlib.sha256()
+        for filepath in publicdataset_files():
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        meta['content'] = digest.hexdigest()
+        save_snapshot_meta(meta)
+    return meta['content']
 
 ##############################################################################
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''Content addressed cache for training artifacts
+
+Artifacts (feature pipeline, calibration fit) are stored in one joblib
+file per key, the fitted forest is exported as arrays by bondapp.py. The
+key is a hash of a fingerprint of the input data, e.g. the content hash
+kept in the snapshot description, and the parameters used to create the
+artifacts.
+'''
+
+import logging
+import hashlib
+import json
+import os
+import time
+
+import joblib
+
+# cache location and eviction limits
+CACHE_DIR = os.path.join('data', 'cache')
+MAX_AGE = 7 * 24 * 3600  # seconds
+MAX_SIZE = 2_000  # MB
+
+logger = logging.getLogger('main')
+
+
+##############################################################################
+def artifact_key(fingerprint, **params):
+    '''hash fingerprint of the input data and training parameters'''
+    h = hashlib.sha256(fingerprint.encode('utf-8'))
+    h.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+##############################################################################
+def load_artifacts(key, rebuild=False):
+    '''return cached artifacts for key or None if missing'''
+    filepath = os.path.join(CACHE_DIR, f'{key}.joblib')
+
+    if rebuild:
+        logger.info('Artifact cache bypassed - rebuild forced')
+        return None
+    if not os.path.isfile(filepath):
+        logger.info('No cached artifacts found')
+        return None
+
+    try:
+        artifacts = joblib.load(filepath)
+    except Exception:
+        logger.warning('Cached artifacts could not be loaded - rebuilding')
+        os.remove(filepath)
+        return None
+
+    # touch file so eviction keeps recently used artifacts
+    os.utime(filepath)
+    logger.info(f'Loaded cached artifacts {key[:12]}')
+    return artifacts
+
+
+##############################################################################
+def save_artifacts(key, **artifacts):
+    '''save artifacts for key and evict old entries'''
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+        logger.info(f'Directory was created: {CACHE_DIR}')
+
+    filepath = os.path.join(CACHE_DIR, f'{key}.joblib')
+    # write to temporary file first so a crash never leaves a broken entry
+    tmp_filepath = f'{filepath}.tmp'
+    joblib.dump(artifacts, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+    logger.info(f'Saved artifacts {key[:12]}')
+
+    evict_cache()
+    return None
+
+
+##############################################################################
+def evict_cache(max_age=MAX_AGE, max_size=MAX_SIZE):
+    '''remove entries older than max_age and oldest entries above max_size'''
+    if not os.path.exists(CACHE_DIR):
+        return None
+
+    now = time.time()
+    entries = []
+    for filename in os.listdir(CACHE_DIR):
+        filepath = os.path.join(CACHE_DIR, filename)
+        stat = os.stat(filepath)
+        if now - stat.st_mtime > max_age:
+            os.remove(filepath)
+            logger.debug(f'Evicted {filename} - age')
+        else:
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+
+    # remove least recently used until size limit is met
+    entries.sort()
+    size = sum(entry[1] for entry in entries) / 1024**2
+    while size > max_size and len(entries) > 1:
+        _, entry_size, filepath = entries.pop(0)
+        os.remove(filepath)
+        size -= entry_size / 1024**2
+        logger.debug(f'Evicted {os.path.basename(filepath)} - size')
+    return None
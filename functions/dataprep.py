@@ -6,109 +6,118 @@ import os
 import datetime as dt
 import pandas as pd
 
+from functions.api import read_publicdataset
+from functions.schema import apply_schema, memory_report
+
 #from sklearn.preprocessing import OneHotEncoder
 
 logger = logging.getLogger('main')
 
-def load_data(fileDir='general'):
+# features used by the random forest
+FEATURE_COLUMNS = ['BiddingStartedOn',  # will be removed
+                   'Age',  # continuous
+                   'Amount', # continuous
+                   'AmountOfPreviousLoansBeforeLoan', # continuous
+                   #'ApplicationSignedHour', # 0-23
+                   #'ApplicationSignedWeekday', # 1-7
+                   'AppliedAmount', # continuous
+                   'BidsApi', # continuous
+                   'BidsManual', # continuous
+                   'BidsPortfolioManager', # continuous
+                   'Country', #
+                   'Education', #
+                   #'EmploymentDurationCurrentEmployer', #
+                   'ExistingLiabilities', # continuous
+                   'Gender', # 0, 1, 2
+                   #'HomeOwnershipType', #
+                   'IncomeTotal', # continuous
+                   'Interest', # continuous
+                   #'LanguageCode', # 1:26
+                   'LiabilitiesTotal', # continuous
+                   'LoanDuration', # continuous
+                   'MonthlyPayment', # continuous
+                   #'MonthlyPaymentDay',
+                   'NewCreditCustomer', # True False
+                   'NoOfPreviousLoansBeforeLoan', # continuous
+                   'PreviousRepaymentsBeforeLoan', # continuous
+                   'ProbabilityOfDefault', # continuous
+                   'Rating',
+                   'VerificationType'
+                   ]
+
+# columns of the public dataset needed for training
+TRAIN_COLUMNS = FEATURE_COLUMNS + ['WorseLateCategory']
+
+# categorical features for one hot encoding
+CATEGORICAL_COLUMNS = ['Country', 'Education', 'Gender', 'Rating', 'VerificationType']
+# categorical features that are coded as numbers
+CODED_COLUMNS = ['Education', 'Gender', 'VerificationType']
+
+# label for each WorseLateCategory - no late payment is not defaulted
+LATE_LABEL = {'1-7': 0,
+              '8-15': 0,
+              '16-30': 0,
+              '31-60': 0,
+              '61-90': 0,
+              '91-120': 0,
+              '121-150': 0,
+              '151-180': 0,
+              '180+': 1}
+
+
+def load_data(fileDir='general', columns=None):
     # get today and create path for saving investment list
     dirName = os.path.join('data', fileDir)
     
     today = dt.datetime.now()
     todayStr = today.strftime('%Y_%m_%d')
-    filename = f'{todayStr}.csv'
-    filepath = os.path.join(dirName, filename)
     
-    # load raw data
-    dataRaw = pd.read_csv(filepath, low_memory=False)
+    # load raw data - public dataset is saved as parquet snapshot, user data as csv
+    if fileDir == 'general':
+        dataRaw = read_publicdataset(columns=columns)
+    else:
+        filepath = os.path.join(dirName, f'{todayStr}.csv')
+        dataRaw = pd.read_csv(filepath, usecols=columns, low_memory=False,
+                              parse_dates=['BiddingStartedOn'])
     length = len(dataRaw)/1000
     logger.info(f'Loaded Data: {length:.1f}k credits')
     return dataRaw
 
 
 ##############################################################################
-def clean_data(dataRaw, mode='train'):
+def clean_data(dataRaw, mode='train', pipeline=None):
+    '''clean raw data and encode features
+    returns the features and the pipeline fitted in train mode'''
     if mode != 'train' or mode != 'apply':
         pass
 
-    if mode == 'train':
-        # create label
-        if True:
-            dataRaw.loc[dataRaw.WorseLateCategory.isnull(), 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '1-7', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '8-15', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '16-30', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '31-60', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '61-90', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '91-120', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '121-150', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '151-180', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.WorseLateCategory == '180+', 'Defaulted'] = 1
-            
-            #dataRaw.loc[dataRaw.Status == 'Repaid', 'Defaulted'] = 0
-            
-        else:
-            dataRaw.loc[dataRaw.Status == 'Late', 'Defaulted'] = 1
-            dataRaw.loc[dataRaw.Status == 'Current', 'Defaulted'] = 0
-            dataRaw.loc[dataRaw.Status == 'Repaid', 'Defaulted'] = 0
-
-    # define features
-    columnsFeatures = ['BiddingStartedOn',  # will be removed                      
-                        'Age',  # continuous
-                        'Amount', # continuous
-                        'AmountOfPreviousLoansBeforeLoan', # continuous
-                        #'ApplicationSignedHour', # 0-23
-                        #'ApplicationSignedWeekday', # 1-7
-                        'AppliedAmount', # continuous
-                        'BidsApi', # continuous
-                        'BidsManual', # continuous
-                        'BidsPortfolioManager', # continuous
-                        'Country', #
-                        'Education', #
-                        #'EmploymentDurationCurrentEmployer', #
-                        'ExistingLiabilities', # continuous
-                        'Gender', # 0, 1, 2
-                        #'HomeOwnershipType', #
-                        'IncomeTotal', # continuous
-                        'Interest', # continuous
-                        #'LanguageCode', # 1:26
-                        'LiabilitiesTotal', # continuous
-                        'LoanDuration', # continuous
-                        'MonthlyPayment', # continuous
-                        #'MonthlyPaymentDay', 
-                        'NewCreditCustomer', # True False
-                        'NoOfPreviousLoansBeforeLoan', # continuous
-                        'PreviousRepaymentsBeforeLoan', # continuous
-                        'ProbabilityOfDefault', # continuous
-                        'Rating',
-                        'VerificationType'
-                        ]
-    
-    if mode == 'train':
-        columnsFeatures.append('Defaulted')
-    
-    # extract features from raw
-    dataPresorted = dataRaw[columnsFeatures].copy()
-    
+    memory_report(dataRaw, f'raw data ({mode})')
+    dataRaw = apply_schema(dataRaw)
+
     # get row count before cleaning 
-    presortedLen = len(dataPresorted.index)
-    # format to datetime and sort
-    dataPresorted.loc[:, 'BiddingStartedOn'] = pd.to_datetime(dataPresorted.BiddingStartedOn).copy()
-    dataPresorted = dataPresorted.sort_values(['BiddingStartedOn'], ascending=True)
-    
+    presortedLen = len(dataRaw.index)
     
     if mode == 'train':
         # remove data prior three months from today
         today = dt.datetime.now()
-        dataSorted = dataPresorted.loc[dataPresorted['BiddingStartedOn'] <= (today - dt.timedelta(days=90)),:].copy()
-        sortedLen = len(dataSorted.index)
+        keep = dataRaw['BiddingStartedOn'] <= (today - dt.timedelta(days=90))
+        # extract features from raw
+        dataPresorted = dataRaw.loc[keep, FEATURE_COLUMNS]
+        # create label - loans more than 180 days late count as defaulted
+        late = dataRaw.loc[keep, 'WorseLateCategory']
+        dataPresorted['Defaulted'] = late.map(LATE_LABEL).where(late.notnull(), 0).astype('float32')
+        sortedLen = len(dataPresorted.index)
         removed = (presortedLen - sortedLen) / presortedLen *100
         logger.info(f'{removed:.2f} % time filtered')
     else:
-        dataSorted = dataPresorted
-        sortedLen = len(dataSorted.index)
+        # extract features from raw
+        dataPresorted = dataRaw.loc[:, FEATURE_COLUMNS]
+        sortedLen = len(dataPresorted.index)
         removed = 0
 
+    # sort by date - BiddingStartedOn is stored as datetime
+    dataSorted = dataPresorted.sort_values(['BiddingStartedOn'], ascending=True)
+
     # additional features
     dataSorted.loc[:, 'AppliedRatio'] = dataSorted.Amount.div(dataSorted.AppliedAmount)
     
@@ -127,11 +136,12 @@ def clean_data(dataRaw, mode='train'):
               'PreviousRepaymentsBeforeLoan': 0,
               'VerificationType': 0
               }
-    dataClean = dataSorted.fillna(values)
+    dataClean = dataSorted
+    dataClean.fillna(values, inplace=True)
     
     
     # remove remaining nan
-    dataClean = dataClean.dropna(axis=0)
+    dataClean.dropna(axis=0, inplace=True)
     
     cleanLen = len(dataClean.index)
     removed = (presortedLen - cleanLen) / presortedLen *100 - removed
@@ -140,55 +150,12 @@ def clean_data(dataRaw, mode='train'):
     elif mode == 'apply' and removed > 0:
         logger.warning(f'Some credits were removed due to NaN values')
 
-    # one hot encoding
-    # define possible categories
-    hours = list(range(0,24))
-    weekday = list(range(1,8))
-    country = ['EE', 'ES', 'FI', 'SK']
-    education = list(range(-1,6))
-    employment = ['MoreThan5Years', 'UpTo3Years',
-                  'UpTo5Years', 'UpTo1Year',
-                  'UpTo2Years', 'UpTo4Years',
-                  'TrialPeriod', 'Retiree', 'Other']
-    gender = list(range(0,3))
-    home = list(range(0,11))
-    language = list(range(1,27))
-    new = [False, True]
-    rating = ['AA', 'A', 'B', 'C', 'D', 'E', 'F', 'HR']
-    veri = list(range(0,5))
-    
-    dummy = dataClean.head(30).copy().reset_index(drop=True)
-    dummy['Age'] = -99
-
-    for ii in range(0,30):
-        dummy.loc[ii, 'VerificationType'] = veri[min(ii,len(veri)-1)]
-        dummy.loc[ii, 'Gender'] = gender[min(ii,len(gender)-1)]
-        #dummy.loc[ii, 'ApplicationSignedHour'] = hours[min(ii,len(hours)-1)]
-        #dummy.loc[ii, 'ApplicationSignedWeekday'] = weekday[min(ii,len(weekday)-1)]
-        dummy.loc[ii, 'Country'] = country[min(ii,len(country)-1)]
-        dummy.loc[ii, 'Education'] = education[min(ii,len(education)-1)]
-        #dummy.loc[ii, 'EmploymentDurationCurrentEmployer'] = employment[min(ii,len(employment)-1)]
-        #dummy.loc[ii, 'HomeOwnershipType'] = home[min(ii,len(home)-1)]
-        #dummy.loc[ii, 'LanguageCode'] = language[min(ii,len(language)-1)]
-        dummy.loc[ii, 'NewCreditCustomer'] = new[min(ii,len(new)-1)]
-        dummy.loc[ii, 'Rating'] = rating[min(ii,len(rating)-1)]
-    
-    dataClean = dataClean.append(dummy, sort=False)
-    
-    # change specific columns numeric to string to trigger dummy creation
-    dataClean['VerificationType'] = dataClean.VerificationType.astype(int).astype(str)
-    dataClean['Gender']  = dataClean.Gender.astype(int).astype(str)
-    #dataClean['ApplicationSignedHour'] = dataClean.ApplicationSignedHour.astype(int).astype(str)
-    #dataClean['ApplicationSignedWeekday'] = dataClean.ApplicationSignedWeekday.astype(int).astype(str)
-    dataClean['Education'] = dataClean.Education.astype(int).astype(str)
-    #dataClean['HomeOwnershipType'] = dataClean.HomeOwnershipType.astype(int).astype(str)
-    #dataClean['LanguageCode'] = dataClean.LanguageCode.astype(int).astype(str)
-
-    dataClean = pd.get_dummies(dataClean)
-
-    # remove dummy rows
-    dataClean = dataClean[dataClean.Age != -99]
-    
+    # one hot encoding with the category vocabulary of the training data
+    if pipeline is None:
+        if mode != 'train':
+            raise ValueError('A fitted pipeline is required in apply mode')
+        pipeline = fit_pipeline(dataClean)
+    dataClean = encode_features(dataClean, pipeline)
     
     sumNan = sum(dataClean.isna().sum())
     logger.debug(f'Number of remaining NaN: {sumNan}')
@@ -200,8 +167,51 @@ def clean_data(dataRaw, mode='train'):
     # drop datetime
     dataClean = dataClean.drop(columns=['BiddingStartedOn'])
     
+    memory_report(dataClean, f'clean data ({mode})')
     logger.info('Finished Data Cleansing')
     
+    return dataClean, pipeline
+
+
+##############################################################################
+def fit_pipeline(dataClean):
+    '''learn category vocabulary and feature order from training data
+    the pipeline is a plain dict and can be saved as json'''
+    categories = {}
+    for col in CATEGORICAL_COLUMNS:
+        values = dataClean[col].dropna().unique()
+        if col in CODED_COLUMNS:
+            values = values.astype(int)
+        categories[col] = sorted(values.tolist())
+
+    # get_dummies appends the encoded columns after the remaining columns
+    features = [col for col in dataClean.columns
+                if col not in categories and col not in ['BiddingStartedOn', 'Defaulted']]
+    for col, values in categories.items():
+        features += [f'{col}_{value}' for value in values]
+
+    pipeline = {'categories': categories,
+                'features': features}
+    return pipeline
+
+
+##############################################################################
+def encode_features(dataClean, pipeline):
+    '''one hot encode categorical columns and align to fitted features'''
+    dataClean = dataClean.copy()
+    for col, categories in pipeline['categories'].items():
+        values = dataClean[col]
+        if col in CODED_COLUMNS:
+            values = values.astype(int)
+        # unknown categories become NaN and are encoded as all zeros
+        dataClean[col] = pd.Categorical(values, categories=categories)
+
+    dataClean = pd.get_dummies(dataClean, columns=list(pipeline['categories']))
+
+    columns = ['BiddingStartedOn'] + pipeline['features']
+    if 'Defaulted' in dataClean.columns:
+        columns.append('Defaulted')
+    dataClean = dataClean.reindex(columns=columns, fill_value=0)
     return dataClean
 
 
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import datetime as dt
-import pandas as pd
 
 from functions.api import update_credentials
 
@@ -10,8 +9,7 @@ def pick_items(user_data, user_id):
     credentials = update_credentials(mode='load')
     user = credentials[user_id]
     
-    # filter for time
-    user_data['BiddingStartedOn'] = pd.to_datetime(user_data.BiddingStartedOn)
+    # filter for time - BiddingStartedOn is stored as datetime
     sell_start = dt.datetime.strptime(user['sell_start'], user['time_fmt'])
     user_data = user_data[user_data.BiddingStartedOn > sell_start]
     
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''Array based inference of the random forest
+
+export_forest flattens the trees of a fitted RandomForestClassifier into
+contiguous numpy arrays. predict_default_prob traverses all trees for a
+batch of credits at once and gives the same probabilities as sklearn's
+predict_proba. This module does not import sklearn, the exported forest
+is loaded memory mapped.
+'''
+
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger('main')
+
+ARRAYS = ['feature', 'threshold', 'children', 'value', 'roots', 'depth']
+# credits traversed at once, limits memory of the traversal
+BATCH = 20_000
+
+
+##############################################################################
+def export_forest(clf, dir_name):
+    '''save trees of clf as contiguous arrays in dir_name'''
+    trees = [est.tree_ for est in clf.estimators_]
+    counts = np.array([tree.node_count for tree in trees])
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    feature, threshold, children, value = [], [], [], []
+    for tree, offset in zip(trees, offsets):
+        nodes = np.arange(tree.node_count) + offset
+        is_leaf = tree.children_left == -1
+        # leaves point to themselves and test any feature
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        right = np.where(is_leaf, nodes, tree.children_right + offset)
+        left = np.where(is_leaf, nodes, tree.children_left + offset)
+        # child of node n is at 2*n + (x <= threshold)
+        children.append(np.stack([right, left], axis=1).ravel())
+        # probability of default per node, normalized like sklearn
+        counts_node = tree.value[:, 0, :]
+        normalizer = counts_node.sum(axis=1)
+        normalizer[normalizer == 0] = 1
+        value.append(counts_node[:, 1] / normalizer)
+
+    forest = {'feature': np.concatenate(feature).astype(np.int64),
+              'threshold': np.concatenate(threshold).astype(np.float64),
+              'children': np.concatenate(children).astype(np.int64),
+              'value': np.concatenate(value).astype(np.float64),
+              'roots': offsets.astype(np.int64),
+              'depth': np.array([max(tree.max_depth for tree in trees)])}
+
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    for name in ARRAYS:
+        filepath = os.path.join(dir_name, f'{name}.npy')
+        # np.save adds the suffix to the temporary file
+        np.save(f'{filepath}.tmp', forest[name])
+        os.replace(f'{filepath}.tmp.npy', filepath)
+    logger.debug(f'Exported {len(trees)} trees with {len(forest["value"])} nodes')
+    return forest
+
+
+##############################################################################
+def forest_exists(dir_name):
+    '''True if all arrays of an exported forest are in dir_name'''
+    return all(os.path.isfile(os.path.join(dir_name, f'{name}.npy')) for name in ARRAYS)
+
+
+##############################################################################
+def remove_forests(dir_name, keep):
+    '''remove everything in dir_name but the exported forest keep'''
+    for name in os.listdir(dir_name):
+        path = os.path.join(dir_name, name)
+        if name == keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        logger.debug(f'Removed exported forest {name}')
+    return None
+
+
+##############################################################################
+def load_forest(dir_name):
+    '''load exported forest memory mapped'''
+    forest = {name: np.load(os.path.join(dir_name, f'{name}.npy'), mmap_mode='r')
+              for name in ARRAYS}
+    return forest
+
+
+##############################################################################
+def predict_default_prob(forest, X):
+    '''probability of default for every row of X'''
+    # sklearn compares float32 features with float64 thresholds
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    result = np.empty(len(X))
+    for start in range(0, len(X), BATCH):
+        result[start:start+BATCH] = _traverse(forest, X[start:start+BATCH])
+    return result
+
+
+##############################################################################
+def _traverse(forest, X):
+    '''traverse all trees for a batch of rows'''
+    n_trees = len(forest['roots'])
+    n_rows, n_features = X.shape
+
+    # one node per tree and row, rows are addressed in the flat X
+    node = np.repeat(np.asarray(forest['roots']), n_rows)
+    row_start = np.tile(np.arange(n_rows, dtype=np.int64) * n_features, n_trees)
+    X = X.ravel()
+    # leaves point to themselves, so every path can take max depth steps
+    for _ in range(int(forest['depth'][0])):
+        x = np.take(X, row_start + np.take(forest['feature'], node))
+        go_left = x <= np.take(forest['threshold'], node)
+        node = np.take(forest['children'], 2 * node + go_left)
+
+    # average over trees in the same order as sklearn
+    leaf_value = np.take(forest['value'], node).reshape(n_trees, n_rows)
+    proba = np.zeros(n_rows)
+    for tree_value in leaf_value:
+        proba += tree_value
+    return proba / n_trees
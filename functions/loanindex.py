@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''LoanId index of the public dataset
+
+The indexed columns of the public dataset are saved sorted by LoanId
+as arrow file together with the sorted LoanIds as numpy array. Both files are memory mapped, so
+a lookup only reads the rows of the requested loans.
+'''
+
+import logging
+import os
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+
+logger = logging.getLogger('main')
+
+# opened index files
+_indexes = {}
+_lock = threading.Lock()
+
+
+##############################################################################
+def build_index(data_raw, dir_name, name):
+    '''save data_raw sorted by LoanId as index files name.arrow and name.npy'''
+    data_raw = data_raw.sort_values('LoanId').reset_index(drop=True)
+
+    table = pa.Table.from_pandas(data_raw, preserve_index=False)
+    filepath = os.path.join(dir_name, f'{name}.arrow')
+    with pa.OSFile(f'{filepath}.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(f'{filepath}.tmp', filepath)
+
+    loan_ids = np.array(data_raw['LoanId'].values, dtype=str)
+    # np.save adds the suffix itself
+    np.save(os.path.join(dir_name, f'{name}.tmp'), loan_ids)
+    os.replace(os.path.join(dir_name, f'{name}.tmp.npy'), os.path.join(dir_name, f'{name}.npy'))
+
+    logger.info(f'LoanId index saved for {len(loan_ids)/1000:.1f}k credits')
+    return [f'{name}.arrow', f'{name}.npy']
+
+
+##############################################################################
+def open_index(dir_name, name):
+    '''memory map index files once'''
+    with _lock:
+        key = os.path.join(dir_name, name)
+        if key not in _indexes:
+            loan_ids = np.load(f'{key}.npy', mmap_mode='r')
+            source = pa.memory_map(f'{key}.arrow', 'r')
+            table = pa.ipc.open_file(source).read_all()
+            _indexes.clear()
+            _indexes[key] = (loan_ids, table)
+    return _indexes[key]
+
+
+##############################################################################
+def lookup_loans(loan_ids, dir_name, name, columns=None):
+    '''public attributes of loan_ids, unknown loans are skipped'''
+    index_ids, table = open_index(dir_name, name)
+
+    loan_ids = np.asarray(loan_ids, dtype=index_ids.dtype)
+    pos = np.searchsorted(index_ids, loan_ids)
+    pos = np.minimum(pos, len(index_ids) - 1)
+    found = index_ids[pos] == loan_ids
+    if not found.all():
+        logger.debug(f'{(~found).sum()} loans not found in index')
+
+    rows = table.take(pa.array(pos[found]))
+    data = rows.to_pandas()
+    if columns is not None:
+        data = data[columns]
+    return data
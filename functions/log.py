@@ -1,39 +1,177 @@
 # -*- coding: utf-8 -*-
+'''Logging of the hourly run
+
+Records are put on a queue and written by a background thread, a slow
+disk does not stall the run. All runs log to one file which is rotated
+by size (or at midnight with ROTATION = 'time'), BACKUP_COUNT old files
+are kept. Long messages such as response bodies are truncated to
+MAX_MESSAGE characters. With json_format every line is a json object.
+'''
+
+import atexit
+import glob
+import json
 import logging
+import logging.handlers
 import datetime as dt
 import os
+import queue
+
+LOG_DIR = 'logs'
+LOG_FILE = 'bondora.log'
+# 'size' rotates after MAX_BYTES, 'time' every midnight
+ROTATION = 'size'
+MAX_BYTES = 10 * 1024**2
+BACKUP_COUNT = 14
+# log files of the old one-file-per-run scheme are removed after
+RETENTION_DAYS = 30
+# longer messages are cut, tracebacks are kept
+MAX_MESSAGE = 2000
+JSON_FORMAT = False
+
+FORMAT = '%(asctime)s - %(levelname)s - %(threadName)s - %(module)s/%(funcName)s - %(message)s'
+
+_listener = None
+_running = False
+
+
+##############################################################################
+class TruncateFilter(logging.Filter):
+    '''cut messages longer than max_length'''
+
+    def __init__(self, max_length=MAX_MESSAGE):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            record.msg = f'{message[:self.max_length]}... [{len(message)} chars]'
+            record.args = None
+        return True
+
+
+##############################################################################
+class JsonFormatter(logging.Formatter):
+    '''one json object per line'''
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'module': record.module,
+                 'func': record.funcName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
 
-def custom_logger(name):
+
+##############################################################################
+class QueueHandler(logging.handlers.QueueHandler):
+    '''queue handler that leaves formatting to the listener'''
+
+    def prepare(self, record):
+        # message and traceback are rendered here as args and exc_info
+        # may not be valid later, formatting is done by the listener
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+##############################################################################
+def remove_old_logs(dir_name, days=RETENTION_DAYS):
+    '''remove log files of the one-file-per-run scheme older than days'''
+    limit = dt.datetime.now() - dt.timedelta(days=days)
+    removed = 0
+    for filepath in glob.glob(os.path.join(dir_name, '????-??-??_??_??_??.log')):
+        if dt.datetime.fromtimestamp(os.path.getmtime(filepath)) < limit:
+            os.remove(filepath)
+            removed += 1
+    return removed
+
+
+##############################################################################
+def custom_logger(name, json_format=JSON_FORMAT):
+    global _listener
     logger = logging.getLogger(name)
     if not len(logger.handlers):
         logger.setLevel(logging.DEBUG)
 
-        formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s/%(funcName)s - %(message)s')
+        if json_format:
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(fmt=FORMAT)
 
         # define directory
-        dirName = os.path.join('logs')
+        dirName = os.path.join(LOG_DIR)
 
         # check if directories exist if not create it
         if not os.path.exists(dirName):
             os.makedirs(dirName)
 
-        now = dt.datetime.now()
-        now_string = now.strftime('%Y-%m-%d_%H_%M_%S')
-        filename = f'{now_string}.log'
-        filepath = os.path.join(dirName, filename)
-        file_handler = logging.FileHandler(filepath)
+        filepath = os.path.join(dirName, LOG_FILE)
+        if ROTATION == 'time':
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                filepath, when='midnight', backupCount=BACKUP_COUNT)
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                filepath, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
         file_handler.setFormatter(formatter)
 
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(formatter)
         stream_handler.setLevel(logging.INFO)
 
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
-        
-        now_string = now.strftime('%Y-%m-%d %H:%M:%S')
+        # the run only puts records on the queue
+        log_queue = queue.Queue(-1)
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(TruncateFilter())
+        logger.addHandler(queue_handler)
+
+        _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler,
+                                                   respect_handler_level=True)
+        removed = remove_old_logs(dirName)
+        start_logger()
+
+        now_string = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         logger.info(f'Logging started on: {now_string}')
         logger.info('################################')
+        if removed > 0:
+            logger.info(f'Removed {removed} old log files')
+    else:
+        # logger of a previous run was stopped
+        start_logger()
     return logger
 
 
+##############################################################################
+def start_logger():
+    '''start writing queued records'''
+    global _running
+    if _listener is not None and not _running:
+        _listener.start()
+        _running = True
+    return None
+
+
+##############################################################################
+def stop_logger():
+    '''write all queued records and stop the listener thread'''
+    global _running
+    if _listener is not None and _running:
+        _listener.stop()
+        _running = False
+        for handler in _listener.handlers:
+            handler.flush()
+    return None
+
+
+# write queued records on exit
+atexit.register(stop_logger)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''Timing spans and counters of the hourly run
+
+Every span and counter is appended as one json line to METRICS_FILE:
+
+    {"time": "...", "run": "...", "type": "span", "name": "clean_data",
+     "seconds": 1.52, "rss_mb": 640.2, "rss_delta_mb": 85.1,
+     "peak_rss_mb": 812.3, "rows": 120345, "status": "ok", ...}
+
+rss_mb is the resident memory of the process at the end of the span,
+rss_delta_mb the change during the span and peak_rss_mb the highest
+resident memory while the span was open. The peak is reset for every
+span via /proc/self/clear_refs, nested spans pass their peak on to the
+outer ones. Spans of other threads share the process memory. Without
+/proc (windows, macOS) the fields are None.
+
+Spans are used as context manager or decorator, values known only at the
+end (rows, status code) are added with set:
+
+    with span('clean_data', mode='train') as s:
+        data = clean_data(...)
+        s.set(rows=len(data))
+
+Counters are summed in memory and written by flush_counters.
+'''
+
+import datetime as dt
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+METRICS_FILE = os.path.join('logs', 'metrics.jsonl')
+STATUS_FILE = '/proc/self/status'
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+
+logger = logging.getLogger('main')
+
+_lock = threading.Lock()
+_counters = {}
+_run = None
+# open spans that need the peak memory before it is reset
+_open_spans = []
+
+
+##############################################################################
+def start_run():
+    '''new run id for all following records'''
+    global _run
+    _run = dt.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    return _run
+
+
+##############################################################################
+def memory_status(keys=('VmRSS', 'VmHWM')):
+    '''resident memory and its peak since the last reset in MB
+    values are None if /proc is not available'''
+    values = dict.fromkeys(keys)
+    try:
+        with open(STATUS_FILE, 'r') as f:
+            for line in f:
+                key = line.split(':')[0]
+                if key in values:
+                    values[key] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return values
+
+
+def reset_peak():
+    '''pass the peak on to the open spans and reset it, False if not possible'''
+    peak = memory_status()['VmHWM']
+    for open_span in _open_spans:
+        open_span.fold_peak(peak)
+    try:
+        with open(CLEAR_REFS_FILE, 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+##############################################################################
+def emit(record):
+    '''append record to the metrics file'''
+    record = {'time': dt.datetime.now().isoformat(timespec='milliseconds'),
+              'run': _run, **record}
+    line = json.dumps(record, default=str)
+    with _lock:
+        dir_name = os.path.dirname(METRICS_FILE)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with open(METRICS_FILE, 'a') as f:
+            f.write(line + '\n')
+    return None
+
+
+##############################################################################
+class Span:
+    '''measures wall-clock time of a block'''
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def set(self, **values):
+        '''add values to the record, e.g. rows'''
+        self.labels.update(values)
+        return self
+
+    def fold_peak(self, peak):
+        '''keep the highest peak seen while the span is open'''
+        if peak is not None and self.peak is not None:
+            self.peak = max(self.peak, peak)
+
+    def __enter__(self):
+        with _lock:
+            self.rss = memory_status()['VmRSS']
+            self.peak = self.rss if reset_peak() else None
+            _open_spans.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            _open_spans.remove(self)
+            status = memory_status()
+            self.fold_peak(status['VmHWM'])
+        rss = status['VmRSS']
+        emit({'type': 'span',
+              'name': self.name,
+              'seconds': round(seconds, 6),
+              'rss_mb': round(rss, 1) if rss is not None else None,
+              'rss_delta_mb': round(rss - self.rss, 1) if rss is not None else None,
+              'peak_rss_mb': round(self.peak, 1) if self.peak is not None else None,
+              'thread': threading.current_thread().name,
+              'status': 'ok' if exc_type is None else exc_type.__name__,
+              **self.labels})
+        # exceptions are not swallowed
+        return False
+
+
+def span(name, **labels):
+    '''context manager timing a block'''
+    return Span(name, **labels)
+
+
+def timed(name, **labels):
+    '''decorator timing every call of a function'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+##############################################################################
+def count(name, value=1, **labels):
+    '''add value to a counter'''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    return None
+
+
+##############################################################################
+def flush_counters():
+    '''write and reset all counters'''
+    with _lock:
+        counters = dict(_counters)
+        _counters.clear()
+    for (name, labels), value in sorted(counters.items(), key=str):
+        emit({'type': 'counter', 'name': name, 'value': value, **dict(labels)})
+    logger.debug(f'{len(counters)} counters written to {METRICS_FILE}')
+    return None
@@ -1,47 +1,61 @@
 # -*- coding: utf-8 -*-
 import logging
+import hashlib
+import json
+import os
+import time
 import numpy as np
 import pandas as pd
 from statistics import stdev
 
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import StratifiedShuffleSplit
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.model_selection import StratifiedShuffleSplit, StratifiedKFold
+from sklearn.model_selection import ParameterSampler, cross_val_score
 
 from sklearn.metrics import roc_curve, auc, r2_score
 
-from functions.analyse import plot_confusion_matrix, area_under_roc, feature_imp
+from functions.inference import predict_default_prob
+from functions.analyse import save_diagnostics
+from functions.metrics import span
 
 logger = logging.getLogger('main')
 
+# number of cross validation splits
+N_SPLITS = 10
+# core budget for training, -1 uses all cores
+N_JOBS = 1
 
-def train_forest(dataClean, Search='off'):
+# incremental training
+MODEL_DIR = os.path.join('data', 'model')
+MAX_UPDATES = 7  # incremental updates before a full retrain
+DRIFT_TOL = 0.02  # allowed AUC drop against the last full fit
+MIN_NEW_TREES = 10  # trees replaced per update
+WINDOW = 50_000  # most recent credits with observed labels used for new trees
+# credits reach 180+ days late only this long after the newest training
+# credits (90 days old), labels of younger credits are mostly not observed
+MATURE_AGE = pd.Timedelta(days=180)
+HOLDOUT = 5_000  # most recent mature credits of the reference AUC
+MIN_HOLDOUT = 500  # newly matured credits needed for the drift check
+
+# hyperparameter search
+SEARCH_FILE = os.path.join(MODEL_DIR, 'search.jsonl')
+SEARCH_MIN_SAMPLES = 10_000  # credits in the first round
+SEARCH_FACTOR = 3  # candidates kept and sample growth per round
+
+
+def train_forest(dataClean, Search='off', n_jobs=N_JOBS):
     X, y, features = get_labels(dataClean)
 
+    # split core budget between parallel folds and trees within a fold
+    n_jobs = effective_n_jobs(n_jobs)
+    fold_jobs = min(n_jobs, N_SPLITS)
+    tree_jobs = max(1, n_jobs // fold_jobs)
+
     if Search=='on':
-        # define search grid
-        n_estimators = [int(x) for x in np.linspace(100, 300, num=10)]
-        max_features = ['auto', 'sqrt']
-        max_depth = [int(x) for x in np.linspace(10, 100, num=11)]
-        max_depth.append(None)
-        min_samples_split = [500, 1000, 2000, 5000]
-        min_samples_leaf = [200, 500 , 1000, 2500]
-        bootstrap = ['True', 'False']
-
-        random_grid = {'n_estimators': n_estimators,
-                       'max_features': max_features,
-                       'max_depth': max_depth,
-                       'min_samples_split': min_samples_split,
-                       'min_samples_leaf': min_samples_leaf,
-                       'bootstrap': bootstrap}
-
-        clf = RandomForestClassifier()
-        clf_random= RandomizedSearchCV(estimator=clf,
-                                       param_distributions=random_grid,
-                                       n_iter=150, cv=3, verbose=5,
-                                       random_state=42,
-                                       n_jobs=1)
-        clf_random.fit(X,y)
+        best_params = search_forest(X, y, features, n_jobs=n_jobs)
 
     # define randomforest regressor
     clf = RandomForestClassifier(n_estimators=166,
@@ -53,9 +67,8 @@ def train_forest(dataClean, Search='off'):
                                  verbose=0,
                                  n_jobs=1, random_state=42)
     
-    if 'clf_random' in locals():
-        gridParams = clf_random.best_params_
-        clf.set_params(**gridParams)
+    if Search=='on':
+        clf.set_params(**best_params)
     
     params = clf.get_params()
     
@@ -67,37 +80,254 @@ def train_forest(dataClean, Search='off'):
     logger.debug(f"Crit: {params['criterion']}")
     
     
-    n = 10
-    cv = StratifiedShuffleSplit(n_splits=n)
-    cv.split(X,y)
+    # folds run in parallel - results are identical to a sequential run
+    # as the splits and the forest use a fixed random_state
+    n = N_SPLITS
+    cv = StratifiedKFold(n_splits=n, shuffle=True, random_state=42)
+    clf.set_params(n_jobs=tree_jobs)
+    logger.debug(f'Training {fold_jobs} folds in parallel with {tree_jobs} cores each')
 
+    folds = list(cv.split(X, y))
+    with span('cv', folds=n, rows=len(y)):
+        results = Parallel(n_jobs=fold_jobs)(
+            delayed(fit_fold)(clone(clf), X, y, train, test)
+            for train, test in folds)
 
+    # every credit is in exactly one test fold - out-of-fold probabilities
+    # replace the predictions on the training data
     aucs = []
-    i = 0
-    for train, test in cv.split(X, y): 
-        probas_ = clf.fit(X[train], y[train]).predict_proba(X[test])
-        # Compute ROC curve and area the curve
-        fpr, tpr, thresholds = roc_curve(y[test], probas_[:, 1])
-
-        roc_auc = auc(fpr, tpr)
-        logger.debug(f'Shuffle: {i+1} of {n} | AUC: {roc_auc:.3f}')
+    y_score = np.empty(len(y))
+    for i, ((_, test), (roc_auc, proba, duration)) in enumerate(zip(folds, results)):
+        logger.debug(f'Fold: {i+1} of {n} | AUC: {roc_auc:.3f} | {duration:.1f}s')
         aucs.append(roc_auc)
+        y_score[test] = proba
 
-        i += 1
+    # final fit on all data with the whole core budget
+    start = time.perf_counter()
+    clf.set_params(n_jobs=n_jobs)
+    with span('final_fit', rows=len(y)):
+        clf.fit(X, y)
+    duration = time.perf_counter() - start
+    logger.debug(f'Final fit | {duration:.1f}s')
     
-    area_under_roc(X, y, clf, plot='no')
-    feature_imp(features, clf)
+    # metrics only, plots are rendered on demand
+    save_diagnostics(y, y_score, features, clf)
     
     avg_auc = np.mean(aucs)
     stdev_auc = stdev(aucs)
     logger.info(f'Finished | Mean AUC: {avg_auc:.3f} | Stdev: {stdev_auc:.4f}')
     
-    return clf, avg_auc
+    return clf, avg_auc, y_score
+
+def search_forest(X, y, features, n_jobs=N_JOBS):
+    '''random search with successive halving
+
+    all candidates are scored on a small sample, only the best third is
+    scored again on three times as many credits until one is left.
+    Every score is saved to SEARCH_FILE with a fingerprint of the data, an
+    interrupted search resumes, a search on changed data or features
+    starts over.
+    '''
+    # define search grid
+    n_estimators = [int(x) for x in np.linspace(100, 300, num=10)]
+    max_features = ['auto', 'sqrt']
+    max_depth = [int(x) for x in np.linspace(10, 100, num=11)]
+    max_depth.append(None)
+    min_samples_split = [500, 1000, 2000, 5000]
+    min_samples_leaf = [200, 500 , 1000, 2500]
+    bootstrap = [True, False]
+
+    random_grid = {'n_estimators': n_estimators,
+                   'max_features': max_features,
+                   'max_depth': max_depth,
+                   'min_samples_split': min_samples_split,
+                   'min_samples_leaf': min_samples_leaf,
+                   'bootstrap': bootstrap}
+
+    candidates = list(ParameterSampler(random_grid, n_iter=150, random_state=42))
+    data = data_fingerprint(X, y, features)
+    results = load_search(data)
+    n_jobs = effective_n_jobs(n_jobs)
+
+    n_samples = SEARCH_MIN_SAMPLES
+    while True:
+        n_samples = min(n_samples, len(y))
+        pending = [params for params in candidates
+                   if search_key(params, n_samples) not in results]
+        logger.info(f'Search: {len(candidates)} candidates on {n_samples} credits'
+                    f' | {len(candidates)-len(pending)} known')
+
+        # score in chunks and save after every chunk to allow resuming
+        for start in range(0, len(pending), n_jobs):
+            chunk = pending[start:start+n_jobs]
+            scores = Parallel(n_jobs=n_jobs)(
+                delayed(score_candidate)(params, X, y, n_samples) for params in chunk)
+            for params, score in zip(chunk, scores):
+                results[search_key(params, n_samples)] = score
+            save_search(chunk, scores, n_samples, data)
+
+        # keep best candidates for the next round
+        candidates.sort(key=lambda params: results[search_key(params, n_samples)],
+                        reverse=True)
+        if len(candidates) == 1 or n_samples == len(y):
+            break
+        candidates = candidates[:int(np.ceil(len(candidates) / SEARCH_FACTOR))]
+        n_samples *= SEARCH_FACTOR
+
+    best_params = candidates[0]
+    logger.info(f'Search finished | AUC: {results[search_key(best_params, n_samples)]:.3f}'
+                f' | {best_params}')
+    return best_params
+
+def score_candidate(params, X, y, n_samples):
+    '''cross validated auc of params on a fixed sample of n_samples credits'''
+    if n_samples < len(y):
+        sample, _ = next(StratifiedShuffleSplit(n_splits=1, train_size=n_samples,
+                                                random_state=42).split(X, y))
+        X, y = X[sample], y[sample]
+    clf = RandomForestClassifier(random_state=42, n_jobs=1, **params)
+    return np.mean(cross_val_score(clf, X, y, cv=3, scoring='roc_auc'))
+
+def search_key(params, n_samples):
+    '''key of a search result'''
+    return json.dumps(params, sort_keys=True) + f'|{n_samples}'
 
-def evaluate_default_prob(clf, dataClean):
-    '''evaluate the true default rate with the predicted probability'''
+def data_fingerprint(X, y, features):
+    '''short hash of features, data and labels of a search'''
+    digest = hashlib.sha1(json.dumps(features).encode())
+    digest.update(np.ascontiguousarray(X).tobytes())
+    digest.update(np.ascontiguousarray(y).tobytes())
+    return digest.hexdigest()[:16]
+
+def load_search(data):
+    '''load saved search results of data'''
+    results = {}
+    if os.path.isfile(SEARCH_FILE):
+        with open(SEARCH_FILE, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # line of an interrupted write
+                    continue
+                if entry.get('data') != data:
+                    continue
+                results[search_key(entry['params'], entry['n_samples'])] = entry['score']
+    return results
+
+def save_search(candidates, scores, n_samples, data):
+    '''append search results of data'''
+    if not os.path.exists(MODEL_DIR):
+        os.makedirs(MODEL_DIR)
+    with open(SEARCH_FILE, 'a') as f:
+        for params, score in zip(candidates, scores):
+            entry = {'params': params, 'n_samples': n_samples, 'score': score, 'data': data}
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    return None
+
+def mature_credits(dates, until):
+    '''credits whose default label is observed if the newest credit is from until'''
+    return np.array(dates <= until - MATURE_AGE)
+
+def holdout_auc(y, y_score, dates):
+    '''AUC of the out-of-fold probabilities on the most recent mature credits
+    reference for the drift check of update_forest'''
+    holdout = np.flatnonzero(mature_credits(dates, dates.max()))[-HOLDOUT:]
+    if len(np.unique(y[holdout])) < 2:
+        return None
+    fpr, tpr, _ = roc_curve(y[holdout], y_score[holdout])
+    return auc(fpr, tpr)
+
+def update_forest(model, dataClean, dates, n_jobs=N_JOBS):
+    '''add trees fitted on recent data to the saved forest and retire
+    the same number of oldest trees
+
+    the drift check uses credits whose labels matured since they were
+    last used for training. They are kept out of the new trees until
+    MIN_HOLDOUT of them are checked, then model['labels_until'] moves on.
+    returns None if a full retrain is needed because the forest lost
+    quality on these credits'''
+    clf = model['clf']
     X, y, features = get_labels(dataClean)
-    compare = pd.DataFrame(clf.predict_proba(X)[:,1], columns={'Prob'})
+    if features != model['features']:
+        logger.info('Features changed - full retrain needed')
+        return None
+    if model.get('holdout_auc') is None or model.get('labels_until') is None:
+        logger.info('No holdout AUC of the last full fit - full retrain needed')
+        return None
+
+    # loans that crossed the time filter since the last training
+    new = np.array(dates > model['trained_until'])
+    if new.sum() == 0:
+        logger.info('No new credits - forest unchanged')
+        return clf
+
+    # credits with observed labels that no tree was fitted on
+    mature = mature_credits(dates, dates.max())
+    holdout = mature & np.array(dates > model['labels_until'])
+    if holdout.sum() >= MIN_HOLDOUT and len(np.unique(y[holdout])) > 1:
+        fpr, tpr, _ = roc_curve(y[holdout], clf.predict_proba(X[holdout])[:, 1])
+        new_auc = auc(fpr, tpr)
+        logger.info(f'AUC on {holdout.sum()} matured credits: {new_auc:.3f}'
+                    f' | last full fit: {model["holdout_auc"]:.3f}')
+        if new_auc < model['holdout_auc'] - DRIFT_TOL:
+            logger.warning('Forest quality degraded - full retrain needed')
+            return None
+        model['labels_until'] = dates[mature].max()
+    else:
+        logger.info(f'{holdout.sum()} matured credits - drift check waits for {MIN_HOLDOUT}')
+        mature = mature & ~holdout
+
+    # replace a share of trees according to the share of new data
+    n_trees = len(clf.estimators_)
+    n_new = min(n_trees, max(MIN_NEW_TREES, int(np.ceil(n_trees * new.mean()))))
+
+    # new trees are fitted on the most recent loans with observed labels,
+    # dataClean is sorted by date
+    window = np.flatnonzero(mature)[-WINDOW:]
+    # with the seed of clf every update would draw the same trees, the seed
+    # of the new trees follows the newest credit
+    seed = int(pd.Timestamp(dates.max()).timestamp()) % 2**31
+    start = time.perf_counter()
+    new_trees = clone(clf).set_params(n_estimators=n_new, random_state=seed,
+                                      n_jobs=effective_n_jobs(n_jobs))
+    new_trees.fit(X[window], y[window])
+    clf.estimators_ = clf.estimators_[n_new:] + new_trees.estimators_
+    duration = time.perf_counter() - start
+    logger.info(f'Replaced {n_new} of {n_trees} trees | {duration:.1f}s')
+    return clf
+
+def load_model():
+    '''load saved forest and its training info or None'''
+    filepath = os.path.join(MODEL_DIR, 'forest.joblib')
+    if not os.path.isfile(filepath):
+        return None
+    return joblib.load(filepath)
+
+def save_model(model):
+    '''save forest and its training info'''
+    if not os.path.exists(MODEL_DIR):
+        os.makedirs(MODEL_DIR)
+    filepath = os.path.join(MODEL_DIR, 'forest.joblib')
+    joblib.dump(model, f'{filepath}.tmp')
+    os.replace(f'{filepath}.tmp', filepath)
+    return None
+
+def fit_fold(clf, X, y, train, test):
+    '''fit one cross validation fold
+    returns auc, probability of default of the test rows and wall-clock time'''
+    start = time.perf_counter()
+    proba = clf.fit(X[train], y[train]).predict_proba(X[test])[:, 1]
+    # Compute ROC curve and area the curve
+    fpr, tpr, thresholds = roc_curve(y[test], proba)
+    roc_auc = auc(fpr, tpr)
+    duration = time.perf_counter() - start
+    return roc_auc, proba, duration
+
+def evaluate_default_prob(y, y_score):
+    '''evaluate the true default rate with the predicted probability
+    y_score are out-of-fold probabilities from train_forest'''
+    compare = pd.DataFrame({'Prob': y_score})
     compare['Prob_bin'] = compare['Prob'].multiply(2.5).round(1).div(2.5)
     compare['True'] = y
     binCount = compare.groupby(['Prob_bin']).count()
@@ -122,9 +352,13 @@ def evaluate_default_prob(clf, dataClean):
     return fit
 
 def apply_forest(fit, clf, userData):
-    '''apply random forest model and fit to default rate'''
+    '''apply random forest model and fit to default rate
+    clf is the sklearn forest or the forest exported with export_forest'''
     X = userData
-    y_pred = clf.predict_proba(X)[:,1]
+    if isinstance(clf, dict):
+        y_pred = predict_default_prob(clf, X)
+    else:
+        y_pred = clf.predict_proba(X)[:,1]
     y_fitted = np.polyval(fit,y_pred)
     return y_fitted
 
@@ -143,5 +377,6 @@ def get_labels(dataClean):
     X = dataClean.drop('Defaulted', axis=1)
     # save feature names
     feature_list = list(X.columns)
-    X = np.array(X)
+    # sklearn uses float32 internally
+    X = X.to_numpy(dtype=np.float32)
     return X, y, feature_list
\ No newline at end of file
@@ -3,26 +3,44 @@
 
 current function:
     check_sales
+    decay_schedule
     adjust_gain
-    cancel_items
-    add_items
-    sell_items
+    load_ledger
+    update_ledger
+    plan_sales
+    reconcile_sales
     '''
 
 import logging
 import datetime as dt
+import os
 import pandas as pd
-from math import ceil
 
-from functions.api import get_secondarymarket, post_cancelitem, post_sellitems
+from functions.api import (get_secondarymarket, post_cancelitem, post_sellitems,
+                           update_credentials, load_unsellable)
 
 logger = logging.getLogger('main')
 
+# default decay schedule of the gain - can be set per user in credentials.json
+DECAY_SCHEDULE = {'decay_step': 1,  # gain reduction per adjustment
+                  'decay_floor': 0,  # lowest gain
+                  'decay_hours': 2}  # time on sale before adjustment
+
+# gain of newly listed items
+NEW_GAIN = 5
+# listings of our account - MarketId is known once the listing shows up,
+# items without Date were not sent and are sent again with their Gain
+LEDGER_COLUMNS = ['LoanPartId', 'MarketId', 'Gain', 'Date']
+# sold items that are not listed yet are not sold again within this time
+PENDING_HOURS = 2
+# items per request
+BATCH_SIZE = 100
+
 ##############################################################################
 def check_sales(userId):
     '''Check currently active sales'''
     # get current items on sale
-    currentSales, _ = get_secondarymarket(userId)
+    currentSales = get_secondarymarket(userId)
     if not(currentSales.empty):
         # filter for relevant info
         currentSales = currentSales.filter(['ListedOnDate',
@@ -41,28 +59,39 @@ def check_sales(userId):
 
 
 ##############################################################################
-def adjust_gain(currentSales):
-    '''Adjust remaining sales'''
+def decay_schedule(userId):
+    '''decay schedule of user - keys in credentials overwrite the default'''
+    credentials = update_credentials(mode='load')
+    user = credentials[userId]
+    schedule = {key: user.get(key, value) for key, value in DECAY_SCHEDULE.items()}
+    return schedule
+
+
+##############################################################################
+def adjust_gain(currentSales, schedule=DECAY_SCHEDULE):
+    '''Adjust remaining sales
+
+    items listed longer than decay_hours get their gain lowered by
+    decay_step, but never below decay_floor
+    '''
     
     now = dt.datetime.now()
     if  not(currentSales.empty):
         # define threshold for changing gain
-        timeThresh = dt.timedelta(hours=2)
-
-        currentSales['NewGain'] = currentSales['Gain']
+        timeThresh = dt.timedelta(hours=schedule['decay_hours'])
 
-        # test all dates and change the gain if threshold is reached
-        for index, row in currentSales.iterrows():
-            if now - row['Date'] > timeThresh:
-                currentSales.at[index,'Date'] = now
-                currentSales.at[index,'NewGain'] = max(0, row['Gain']-1)
+        # test all dates and lower the gain if threshold is reached
+        due = (now - currentSales['Date']) > timeThresh
+        newGain = currentSales['Gain'].sub(schedule['decay_step'])
+        newGain = newGain.clip(lower=schedule['decay_floor'])
+        # gains that are already below the floor are not raised
+        newGain = newGain.where(newGain < currentSales['Gain'], currentSales['Gain'])
 
-        # drop unchanged credits
-        adjustedSales = currentSales[currentSales.Gain != currentSales.NewGain].copy()
-        # save new gain
-        adjustedSales['Gain'] = adjustedSales['NewGain']
-
-        adjustedSales = adjustedSales.drop(columns='NewGain')
+        # keep changed credits only and save new gain
+        changed = due & (newGain != currentSales['Gain'])
+        adjustedSales = currentSales[changed].copy()
+        adjustedSales['Gain'] = newGain[changed]
+        adjustedSales['Date'] = now
 
     else:
         adjustedSales = currentSales
@@ -71,58 +100,125 @@ def adjust_gain(currentSales):
 
 
 ##############################################################################
-def cancel_items(userId, adjustedSales, now):
-    '''cancel all items that were adjusted'''
-    if not(adjustedSales.empty):
-        reqPosts = ceil(len(adjustedSales)/100)
-        
-        tmp = adjustedSales['MarketId']
-        for noPost in range(1, reqPosts+1):
-            items = tmp[(noPost-1)*100:(noPost)*100]
-            items = items.to_list()
-            # cancel the items
-            post_cancelitem(userId, items)
-    else:
-        logger.info('No items to cancel')
+def ledger_filepath(user_id):
+    '''file of the listings of user'''
+    user = update_credentials(mode='load')[user_id]
+    return os.path.join('data', user['name'], 'ledger.csv')
 
 
+##############################################################################
+def load_ledger(user_id):
+    '''listings of the last run'''
+    filepath = ledger_filepath(user_id)
+    if not os.path.isfile(filepath):
+        return pd.DataFrame(columns=LEDGER_COLUMNS)
+    return pd.read_csv(filepath, parse_dates=['Date'])
+
 
 ##############################################################################
-def add_items(adjusted_sales, items):
-    '''add items to adjustesSales list and init date and gain'''
-    # add date and standard gain to new items
-    if not(items.empty):
-        items['Date'] = dt.datetime.now()
-        items['Gain'] = 5
-        
-        if not(adjusted_sales.empty):
-            items = items[~items['LoanPartId'].isin(adjusted_sales['LoanPartId'])]
-
-    # append adjustedSales with new items
-    added_sales = adjusted_sales.append(items, sort=True)
-    
-    added_sales.Gain = added_sales.Gain.astype(int)
-    return added_sales
+def save_ledger(user_id, ledger):
+    '''save listings atomically'''
+    filepath = ledger_filepath(user_id)
+    dir_name = os.path.dirname(filepath)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    ledger[LEDGER_COLUMNS].to_csv(f'{filepath}.tmp', index=False)
+    os.replace(f'{filepath}.tmp', filepath)
+    return None
 
 
 ##############################################################################
-def sell_items(user_id, added_sales):
-    ''' make request and save latest sales'''
-    prev = len(added_sales)
-    added_sales = added_sales.drop_duplicates(subset='LoanPartId')
-    after = len(added_sales)
-    if prev-after > 0:
-        logger.warning(f'Removed {prev-after} duplicates')
-    if not(added_sales.empty):
-        req_posts = ceil(after/100)
-        added_sales = added_sales[['LoanPartId', 'Gain']]
-        for no_post in range(1,req_posts+1):
-            items = added_sales[(no_post-1)*100:(no_post)*100]
-            items = items.rename(index=str, columns={'Gain': 'DesiredDiscountRate'})
-    
-            # format to required format for api
-            items = items.to_dict(orient='records')
-            post_sellitems(user_id, items)
-    else:
-        logger.info('No items to sell')
+def update_ledger(ledger, currentSales, now):
+    '''current listings and items sold recently that are not listed yet
 
+    listings of the ledger that are gone were sold or cancelled by Bondora
+    '''
+    if currentSales.empty:
+        currentSales = pd.DataFrame(columns=LEDGER_COLUMNS)
+    listed = ledger['LoanPartId'].isin(currentSales['LoanPartId'])
+
+    pending = (~listed & ledger['MarketId'].isnull()
+               & (now - ledger['Date'] < dt.timedelta(hours=PENDING_HOURS)))
+    unsent = ~listed & ledger['Date'].isnull()
+    gone = ~listed & ~pending & ~unsent
+    if gone.sum() > 0:
+        logger.info(f'{gone.sum()} listings were sold or removed since the last run')
+
+    ledger = pd.concat([currentSales[LEDGER_COLUMNS], ledger.loc[pending | unsent, LEDGER_COLUMNS]],
+                       ignore_index=True, sort=False)
+    return ledger
+
+
+##############################################################################
+def plan_sales(ledger, items, schedule=DECAY_SCHEDULE):
+    '''items to sell compared to the ledger
+
+    due listings get a lower gain, their MarketId has to be cancelled first.
+    New items are sold with NEW_GAIN, items in the ledger and listings
+    with an unchanged gain are left alone. Pending items have no MarketId
+    yet and are not repriced even if decay_hours < PENDING_HOURS, unsent
+    items are sold again with their gain
+    '''
+    listed = ledger[ledger['MarketId'].notnull()]
+    adjustedSales, now = adjust_gain(listed, schedule)
+    unsent = ledger[ledger['MarketId'].isnull() & ledger['Date'].isnull()].assign(Date=now)
+
+    newItems = items[~items['LoanPartId'].isin(ledger['LoanPartId'])]
+    newItems = newItems.drop_duplicates(subset='LoanPartId').assign(
+        MarketId=None, Gain=NEW_GAIN, Date=now)
+
+    plannedSales = pd.concat([adjustedSales[LEDGER_COLUMNS], unsent[LEDGER_COLUMNS],
+                              newItems[LEDGER_COLUMNS]], ignore_index=True, sort=False)
+    logger.info(f'{len(adjustedSales)} listings to reprice | {len(unsent)} unsent'
+                f' | {len(newItems)} new items'
+                f' | {len(ledger) - len(adjustedSales) - len(unsent)} unchanged')
+    return plannedSales, now
+
+
+##############################################################################
+def reconcile_sales(user_id, currentSales, items, schedule=DECAY_SCHEDULE):
+    '''bring the listings of user to the planned state with the fewest requests
+
+    a reprice is a cancel and a sell as the API can not change a listing,
+    both are sent batch by batch so listings are delisted only briefly
+    '''
+    ledger = update_ledger(load_ledger(user_id), currentSales, dt.datetime.now())
+    plannedSales, now = plan_sales(ledger, items, schedule)
+
+    # items rejected recently are neither cancelled nor sold again
+    unsellable = load_unsellable(user_id)
+    if unsellable:
+        known = plannedSales['LoanPartId'].isin(list(unsellable))
+        if known.sum() > 0:
+            logger.info(f'Skipped {known.sum()} credits that could not be sold recently')
+        plannedSales = plannedSales[~known]
+
+    for start in range(0, len(plannedSales), BATCH_SIZE):
+        batch = plannedSales[start:start+BATCH_SIZE]
+        marketIds = batch['MarketId'].dropna().to_list()
+        if marketIds:
+            post_cancelitem(user_id, marketIds)
+
+        batch = batch.assign(Gain=batch['Gain'].astype(int))
+        sellItems = batch[['LoanPartId', 'Gain']].rename(columns={'Gain': 'DesiredDiscountRate'})
+        rejected, unsent = post_sellitems(user_id, sellItems.to_dict(orient='records'))
+
+        # sent items are pending until they show up on the market, unsent
+        # items keep their gain without Date and are sent again next run
+        sent = ~batch['LoanPartId'].isin(rejected + unsent)
+        listed = batch[sent].assign(MarketId=None, Date=now)
+        retry = batch[batch['LoanPartId'].isin(unsent)].assign(MarketId=None, Date=pd.NaT)
+        ledger = ledger[~ledger['LoanPartId'].isin(batch['LoanPartId'])]
+        ledger = pd.concat([ledger, listed[LEDGER_COLUMNS], retry[LEDGER_COLUMNS]],
+                           ignore_index=True, sort=False)
+        if unsent:
+            # keep the remaining listings at their price instead of
+            # cancelling them while the API refuses requests
+            logger.warning(f'Stopped after {len(unsent)} unsent credits'
+                           f' - {len(plannedSales) - start - len(batch)} changes left for next run')
+            break
+
+    if plannedSales.empty:
+        logger.info('Listings unchanged')
+    save_ledger(user_id, ledger)
+    return ledger
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''Compact dtypes of the loan data
+
+Numbers are stored as float32, low cardinality strings as categories
+and flags as booleans. Columns that are not listed keep their default.
+'''
+
+import logging
+
+logger = logging.getLogger('main')
+
+# float32 keeps NaN, sklearn works with float32 anyway
+FLOAT_COLUMNS = ['Age',
+                 'Amount',
+                 'AmountOfPreviousLoansBeforeLoan',
+                 'AppliedAmount',
+                 'BidsApi',
+                 'BidsManual',
+                 'BidsPortfolioManager',
+                 'Education',
+                 'ExistingLiabilities',
+                 'Gender',
+                 'IncomeTotal',
+                 'Interest',
+                 'LiabilitiesTotal',
+                 'LoanDuration',
+                 'MonthlyPayment',
+                 'NoOfPreviousLoansBeforeLoan',
+                 'PreviousRepaymentsBeforeLoan',
+                 'ProbabilityOfDefault',
+                 'VerificationType']
+
+CATEGORY_COLUMNS = ['Country',
+                    'EmploymentDurationCurrentEmployer',
+                    'Rating',
+                    'Status',
+                    'WorseLateCategory']
+
+BOOL_COLUMNS = ['NewCreditCustomer']
+
+DTYPES = {**{col: 'float32' for col in FLOAT_COLUMNS},
+          **{col: 'category' for col in CATEGORY_COLUMNS},
+          **{col: 'bool' for col in BOOL_COLUMNS}}
+
+
+##############################################################################
+def apply_schema(data):
+    '''convert columns of data to the compact dtypes'''
+    dtypes = {col: dtype for col, dtype in DTYPES.items()
+              if col in data.columns and data[col].dtype != dtype}
+    if dtypes:
+        data = data.astype(dtypes)
+    return data
+
+
+##############################################################################
+def memory_report(data, stage):
+    '''log memory usage of data'''
+    size = data.memory_usage(deep=True).sum() / 1024**2
+    logger.info(f'Memory {stage}: {size:.1f} MB for {len(data)/1000:.1f}k rows')
+    return size
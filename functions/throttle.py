@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''Throttle state and rate limiter of the Bondora API
+
+Keeps the next allowed request time per user and endpoint in memory.
+The state is written to its own file atomically and in batches instead
+of rewriting credentials.json after every request.
+
+Every user and endpoint has its own bucket holding one token, which
+refills wait_time seconds after it was taken. Callers reserve the next
+token and only the calling thread waits for it, so requests of other
+users and endpoints keep running.
+'''
+
+import asyncio
+import atexit
+import logging
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+STATE_FILE = os.path.join('data', 'throttle.json')
+TIME_FMT = '%Y-%m-%dT%H:%M:%S.%f'
+# flush after this many updates or seconds
+FLUSH_EVERY = 20
+FLUSH_INTERVAL = 60
+# updates with a longer wait are flushed at once, losing them after a
+# crash would lead to too many requests
+LONG_WAIT = 60
+
+logger = logging.getLogger('main')
+
+_lock = threading.RLock()
+_state = None
+_dirty = 0
+_last_flush = time.time()
+
+
+##############################################################################
+def _load_state():
+    '''load state file once'''
+    global _state
+    if _state is None:
+        if os.path.isfile(STATE_FILE):
+            with open(STATE_FILE, 'r') as f:
+                _state = json.load(f)
+        else:
+            _state = {}
+    return _state
+
+
+##############################################################################
+def next_request(user_id, req_name, default=None):
+    '''next allowed time for req_name or default if unknown'''
+    with _lock:
+        state = _load_state()
+        try:
+            return dt.datetime.strptime(state[str(user_id)][req_name], TIME_FMT)
+        except KeyError:
+            return default
+
+
+##############################################################################
+def set_next_request(user_id, req_name, next_time, wait_time=0):
+    '''update next allowed time and flush if needed'''
+    global _dirty
+    with _lock:
+        state = _load_state()
+        state.setdefault(str(user_id), {})[req_name] = next_time.strftime(TIME_FMT)
+        _dirty += 1
+        flush_state(force=wait_time >= LONG_WAIT)
+    return None
+
+
+##############################################################################
+def flush_state(force=False):
+    '''write state atomically if enough updates are pending'''
+    global _dirty, _last_flush
+    with _lock:
+        if _state is None or _dirty == 0:
+            return None
+        due = _dirty >= FLUSH_EVERY or time.time() - _last_flush > FLUSH_INTERVAL
+        if not (force or due):
+            return None
+
+        dir_name = os.path.dirname(STATE_FILE)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        # write to temporary file and replace, the old state stays
+        # valid if the process dies while writing
+        tmp_filepath = f'{STATE_FILE}.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(_state, f, indent=4, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, STATE_FILE)
+
+        logger.debug(f'Throttle state saved - {_dirty} updates')
+        _dirty = 0
+        _last_flush = time.time()
+    return None
+
+
+##############################################################################
+def eta(user_id, req_name, default=None):
+    '''seconds until the next token of the bucket is available'''
+    now = dt.datetime.now()
+    next_time = next_request(user_id, req_name, default=default) or now
+    return max(0, (next_time - now).total_seconds())
+
+
+##############################################################################
+def try_acquire(user_id, req_name, wait_time, default=None):
+    '''take the token if available without waiting
+    returns True and 0 or False and the seconds until it is available'''
+    with _lock:
+        delay = eta(user_id, req_name, default=default)
+        if delay > 0:
+            return False, delay
+        reserve(user_id, req_name, wait_time, default=default)
+    return True, 0
+
+
+##############################################################################
+def reserve(user_id, req_name, wait_time, default=None):
+    '''reserve the next token of the bucket and return the seconds to wait'''
+    with _lock:
+        now = dt.datetime.now()
+        next_time = next_request(user_id, req_name, default=default) or now
+        slot = max(now, next_time)
+        set_next_request(user_id, req_name,
+                         slot + dt.timedelta(seconds=wait_time), wait_time)
+    return (slot - now).total_seconds()
+
+
+##############################################################################
+def acquire(user_id, req_name, wait_time, default=None):
+    '''wait in the calling thread until a token is available'''
+    delay = reserve(user_id, req_name, wait_time, default=default)
+    if delay > 0:
+        logger.debug(f'Next {req_name} for user {user_id} in {delay:.0f}s')
+        time.sleep(delay)
+    return None
+
+
+##############################################################################
+async def acquire_async(user_id, req_name, wait_time, default=None):
+    '''await a token without blocking the event loop'''
+    delay = reserve(user_id, req_name, wait_time, default=default)
+    if delay > 0:
+        logger.debug(f'Next {req_name} for user {user_id} in {delay:.0f}s')
+        await asyncio.sleep(delay)
+    return None
+
+
+# write pending updates on exit
+atexit.register(flush_state, force=True)
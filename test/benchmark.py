@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''Benchmark of the pipeline stages on synthetic LoanData
+
+Times every stage and measures its peak memory with tracemalloc.
+Results can be saved as json baseline and later runs compared against
+it, stages that got slower or need more memory than the tolerance are
+flagged and the script exits with 1.
+
+    python test/benchmark.py --rows 100000 1000000 --save test/baselines/local.json
+    python test/benchmark.py --rows 100000 1000000 --compare test/baselines/local.json
+
+Run it from the repository root, train_forest writes its diagnostics to
+data/model. The API stages of the sales manager (check_sales and the
+requests of reconcile_sales) are not included. Memory of joblib worker
+processes is not measured.
+'''
+
+import argparse
+import datetime as dt
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+basepath = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(basepath, '..')))
+
+import functions as fcs
+from functions import api
+import synthetic
+
+# stages with less difference are not flagged
+MIN_SECONDS = 0.05
+MIN_MB = 1
+# share of the public dataset a user has invested in
+USER_SHARE = 0.01
+
+
+##############################################################################
+def measure(func, repeat):
+    '''best time of repeat runs and peak memory of one run'''
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': min(times), 'peak_mb': peak / 1024**2}
+
+
+##############################################################################
+def run_stages(n_rows, repeat, n_jobs, stages, seed=0):
+    '''run all stages on n_rows synthetic credits'''
+    # user settings for pick_items
+    with open(os.path.join(basepath, '..', 'data_example', 'credentials_example.json')) as f:
+        api._credentials = json.load(f)
+
+    public_raw = synthetic.public_dataset(n_rows, seed=seed)
+    user_raw = synthetic.investments(public_raw, max(100, int(n_rows * USER_SHARE)), seed=seed)
+    sales = synthetic.current_sales(max(100, int(n_rows * USER_SHARE / 10)), seed=seed)
+    results = {}
+
+    def stage(name, func):
+        # stages that are not measured still run for the later stages
+        if name not in stages:
+            return func()
+        result, results[name] = measure(func, repeat)
+        print(f"{n_rows:>9} {name:<22} {results[name]['seconds']:9.3f}s"
+              f" {results[name]['peak_mb']:9.1f} MB", flush=True)
+        return result
+
+    public_clean, pipeline = stage('clean_data', lambda: fcs.clean_data(public_raw, mode='train'))
+    clf, _, y_score = stage('train_forest', lambda: fcs.train_forest(public_clean, n_jobs=n_jobs))
+    y = public_clean['Defaulted'].values
+    fit = stage('evaluate_default_prob', lambda: fcs.evaluate_default_prob(y, y_score))
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        fcs.export_forest(clf, dir_name)
+        forest = fcs.load_forest(dir_name)
+        user_clean, _ = stage('clean_data_apply',
+                              lambda: fcs.clean_data(user_raw, mode='apply', pipeline=pipeline))
+        prob = stage('apply_forest', lambda: fcs.apply_forest(fit, forest, user_clean))
+        # same scoring with the sklearn forest the arrays were exported from
+        prob_sklearn = stage('apply_forest_sklearn', lambda: fcs.apply_forest(fit, clf, user_clean))
+        if 'apply_forest_sklearn' in stages:
+            print(f"{n_rows:>9} {'max diff':<22} {np.abs(prob - prob_sklearn).max():9.2e}")
+        # user_clean is sorted and without NaN rows, align by index
+        user_raw['Prob_fitted'] = pd.Series(prob, index=user_clean.index)
+        del forest
+
+    user_raw['adjInt'] = stage('calculate_adjInt', lambda: fcs.calculate_adjInt(user_raw))
+    user_result = stage('pick_items', lambda: fcs.pick_items(user_raw, 0))
+
+    stage('adjust_gain', lambda: fcs.adjust_gain(sales))
+    stage('plan_sales', lambda: fcs.plan_sales(sales, user_result[['LoanPartId']]))
+    return results
+
+
+##############################################################################
+def compare(results, baseline, tolerance):
+    '''stages that are slower or need more memory than the baseline'''
+    regressions = []
+    for rows, stages in results.items():
+        for name, current in stages.items():
+            previous = baseline['results'].get(rows, {}).get(name)
+            if previous is None:
+                continue
+            time_ratio = current['seconds'] / max(previous['seconds'], 1e-9)
+            mem_ratio = current['peak_mb'] / max(previous['peak_mb'], 1e-9)
+            slower = (time_ratio > 1 + tolerance
+                      and current['seconds'] - previous['seconds'] > MIN_SECONDS)
+            larger = (mem_ratio > 1 + tolerance
+                      and current['peak_mb'] - previous['peak_mb'] > MIN_MB)
+            flag = 'REGRESSION' if slower or larger else 'ok'
+            print(f'{rows:>9} {name:<22} time x{time_ratio:5.2f}  memory x{mem_ratio:5.2f}  {flag}')
+            if slower or larger:
+                regressions.append((rows, name))
+    return regressions
+
+
+##############################################################################
+def main():
+    stages = ['clean_data', 'train_forest', 'evaluate_default_prob', 'clean_data_apply',
+              'apply_forest', 'apply_forest_sklearn', 'calculate_adjInt', 'pick_items', 'adjust_gain', 'plan_sales']
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000],
+                        help='sizes of the synthetic public dataset')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='cores for train_forest')
+    parser.add_argument('--stages', nargs='+', default=stages, choices=stages,
+                        help='stages to measure')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='save results as baseline json')
+    parser.add_argument('--compare', help='baseline json to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative increase of time and memory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    for n_rows in args.rows:
+        results[str(n_rows)] = run_stages(n_rows, args.repeat, args.n_jobs,
+                                          args.stages, seed=args.seed)
+
+    report = {'meta': {'date': dt.datetime.now().isoformat(timespec='seconds'),
+                       'machine': platform.node(),
+                       'cpus': os.cpu_count(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'pandas': pd.__version__,
+                       'sklearn': sklearn.__version__,
+                       'repeat': args.repeat,
+                       'n_jobs': args.n_jobs,
+                       'seed': args.seed},
+              'results': results}
+
+    if args.save:
+        dir_name = os.path.dirname(args.save)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Baseline saved to {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} from {baseline['meta']['date']}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regressions')
+            sys.exit(1)
+    return None
+
+
+if __name__ == '__main__':
+    main()
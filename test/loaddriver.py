@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''Load driver for the request layer of functions/api.py
+
+Runs N simulated accounts against the local stand-in of the Bondora API
+(test/mockserver.py), each account in its own thread like bondapp. Every
+cycle of an account requests its balance, a page of investments and its
+items on sale, sells a batch of loan parts with post_sellitems and
+cancels the listed items again. All requests go through
+api.bondora_request with its throttle and pooled session.
+
+Reports throughput, latency percentiles per endpoint and the status
+codes the client received. The status codes the local server sent are
+reported as well, both should match as the sessions do not retry
+requests that reached the server.
+
+    python test/loaddriver.py --accounts 10 --cycles 20 --latency 0.05
+    python test/loaddriver.py --accounts 3 --min-interval 2 --wait 1
+
+Requests of the same account to the same endpoint are spaced by --wait
+seconds by the client throttle, sell and cancel keep the 1s of api.py.
+'''
+
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+basepath = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(basepath, '..')))
+
+from functions import api, throttle
+import mockserver
+
+PERCENTILES = [50, 95, 99]
+
+
+##############################################################################
+class Recorder:
+    '''latency and status of every request'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def wrap(self, request):
+        '''time every call of request'''
+        def timed_request(user_id, req_type, req_name, *args, **kwargs):
+            start = time.perf_counter()
+            r, credentials = request(user_id, req_type, req_name, *args, **kwargs)
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.samples.append((req_name, r.status_code, duration))
+            return r, credentials
+        return timed_request
+
+    def report(self, wall_time):
+        '''throughput, latency percentiles and status codes'''
+        result = {'requests': len(self.samples),
+                  'seconds': wall_time,
+                  'throughput': len(self.samples) / wall_time,
+                  'endpoints': {}}
+        for req_name in sorted({sample[0] for sample in self.samples}):
+            durations = np.array([s[2] for s in self.samples if s[0] == req_name])
+            statuses = [s[1] for s in self.samples if s[0] == req_name]
+            stats = {f'p{p}': float(np.percentile(durations, p)) for p in PERCENTILES}
+            stats['max'] = float(durations.max())
+            stats['count'] = len(durations)
+            stats['status'] = {str(code): statuses.count(code) for code in sorted(set(statuses))}
+            result['endpoints'][req_name] = stats
+        return result
+
+
+##############################################################################
+def setup_accounts(n_accounts, url):
+    '''point api.py to url and create credentials of n_accounts'''
+    api.URLBASE = url
+    api._credentials = [{'ID': i,
+                         'name': f'load-{i}',
+                         'token': f'token-{i}',
+                         'time_fmt': '%Y-%m-%dT%H:%M:%S',
+                         'sell_start': '2019-01-01T00:00:00'}
+                        for i in range(n_accounts)]
+    api._sessions.clear()
+
+    # own throttle state, the real one is not touched
+    throttle.STATE_FILE = os.path.join(tempfile.mkdtemp(), 'throttle.json')
+    throttle._state = {}
+    return None
+
+
+##############################################################################
+def run_account(user_id, cycles, wait, page_size, seed):
+    '''request cycles of one account'''
+    threading.current_thread().name = f'user-{user_id}'
+    rng = random.Random(f'{seed}-{user_id}')
+    for _ in range(cycles):
+        api.bondora_request(user_id, 'GET', 'account/balance', wait_time=wait)
+
+        r, _ = api.bondora_request(user_id, 'GET', 'account/investments',
+                                   params={'SalesStatus': 3, 'PageSize': page_size, 'PageNr': 1},
+                                   wait_time=wait)
+        investments = json.loads(r.text)['Payload'] if r.status_code == 200 else []
+
+        if investments:
+            batch = rng.sample(investments, min(100, len(investments)))
+            items = [{'LoanPartId': item['LoanPartId'], 'DesiredDiscountRate': 5}
+                     for item in batch]
+            api.post_sellitems(user_id, items)
+
+        r, _ = api.bondora_request(user_id, 'GET', 'secondarymarket',
+                                   params={'ShowMyItems': True, 'PageSize': page_size, 'PageNr': 1},
+                                   wait_time=wait)
+        on_sale = json.loads(r.text)['Payload'] if r.status_code == 200 else []
+        if on_sale:
+            api.post_cancelitem(user_id, [item['Id'] for item in on_sale[:100]])
+    return None
+
+
+##############################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=3, help='simulated accounts')
+    parser.add_argument('--cycles', type=int, default=10, help='request cycles per account')
+    parser.add_argument('--wait', type=float, default=0,
+                        help='client throttle of the GET requests in seconds')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--url', help='running server, a local one is started otherwise')
+    parser.add_argument('--investments', type=int, default=1000,
+                        help='loan parts of every account of the local server')
+    parser.add_argument('--unsellable', type=float, default=0.05,
+                        help='share of loan parts that return 409')
+    parser.add_argument('--min-interval', type=float, default=0,
+                        help='server side 429 limit per account and endpoint')
+    parser.add_argument('--latency', type=float, default=0.02, help='server latency')
+    parser.add_argument('--jitter', type=float, default=0.02, help='random extra latency')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='save report as json')
+    parser.add_argument('--verbose', action='store_true', help='show log of api.py')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+    server = None
+    url = args.url
+    if url is None:
+        state = mockserver.MockState(n_investments=args.investments,
+                                     unsellable=args.unsellable,
+                                     min_interval=args.min_interval,
+                                     latency=args.latency, jitter=args.jitter,
+                                     seed=args.seed)
+        server, url = mockserver.start_server(state)
+    setup_accounts(args.accounts, url)
+
+    recorder = Recorder()
+    api.bondora_request = recorder.wrap(api.bondora_request)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.accounts) as executor:
+        futures = [executor.submit(run_account, user_id, args.cycles, args.wait,
+                                   args.page_size, args.seed)
+                   for user_id in range(args.accounts)]
+        for future in futures:
+            future.result()
+    wall_time = time.perf_counter() - start
+
+    report = recorder.report(wall_time)
+    if server is not None:
+        server.shutdown()
+        report['server'] = dict(sorted(state.counts.items()))
+    report['meta'] = {'date': dt.datetime.now().isoformat(timespec='seconds'),
+                      'url': url,
+                      **{key: value for key, value in vars(args).items()
+                         if key not in ['save', 'verbose', 'url']}}
+
+    print(f"{report['requests']} requests in {wall_time:.1f}s"
+          f" | {report['throughput']:.1f} requests/s | {args.accounts} accounts")
+    for req_name, stats in report['endpoints'].items():
+        latency = ' '.join(f'p{p} {stats[f"p{p}"]*1000:7.1f}ms' for p in PERCENTILES)
+        print(f"{req_name:<24} {stats['count']:>6} | {latency} | max {stats['max']*1000:7.1f}ms"
+              f" | {stats['status']}")
+    if 'server' in report:
+        print(f"server sent: {report['server']}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Report saved to {args.save}')
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+'''Local stand-in of the Bondora API
+
+Implements the endpoints used in functions/api.py with the same json
+layout (Payload, TotalCount, PageNr, Errors):
+
+    GET  account/balance
+    GET  account/investments      paged
+    GET  secondarymarket          paged, items on sale of the account
+    POST secondarymarket/sell     409 with one error per unsellable item
+    POST secondarymarket/cancel
+
+Accounts are identified by their bearer token and created on first use
+with n_investments synthetic loan parts. Requests of an account to the
+same endpoint within min_interval seconds get a 429. Every response is
+delayed by latency seconds plus random jitter.
+
+    python test/mockserver.py --port 8080 --latency 0.05 --min-interval 1
+
+and point api.URLBASE to http://localhost:8080/api/v1/
+'''
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PREFIX = '/api/v1/'
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+MAX_PAGE_SIZE = 50_000
+MAX_ITEMS = 100
+
+
+##############################################################################
+class MockState:
+    '''accounts, their investments and items on sale'''
+
+    def __init__(self, n_investments=1000, unsellable=0.05, min_interval=0,
+                 latency=0, jitter=0, seed=0):
+        self.n_investments = n_investments
+        self.unsellable = unsellable
+        self.min_interval = min_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.accounts = {}
+        self.last_request = {}
+        self.counts = {}
+
+    def account(self, token):
+        '''account of token, created on first use'''
+        with self.lock:
+            if token not in self.accounts:
+                rng = random.Random(f'{self.seed}-{token}')
+                now = dt.datetime.now()
+                investments = {}
+                for _ in range(self.n_investments):
+                    part_id = str(uuid.UUID(int=rng.getrandbits(128)))
+                    investments[part_id] = {
+                        'LoanPartId': part_id,
+                        'LoanId': str(uuid.UUID(int=rng.getrandbits(128))),
+                        'Amount': round(rng.uniform(1, 100), 2),
+                        'Interest': round(rng.uniform(10, 100), 2),
+                        'PurchaseDate': (now - dt.timedelta(days=rng.randint(1, 900))).strftime(TIME_FMT),
+                        'NextPaymentNr': rng.randint(1, 3),
+                        'ListedInSecondMarketOn': None}
+                self.accounts[token] = {'investments': investments, 'market': {},
+                                        'balance': round(rng.uniform(0, 1000), 2)}
+            return self.accounts[token]
+
+    def throttled(self, token, endpoint):
+        '''seconds until the next request is allowed or 0'''
+        if self.min_interval <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            last = self.last_request.get((token, endpoint))
+            if last is not None and now - last < self.min_interval:
+                return self.min_interval - (now - last)
+            self.last_request[(token, endpoint)] = now
+        return 0
+
+    def count(self, endpoint, status):
+        '''count responses per endpoint and status'''
+        with self.lock:
+            key = f'{endpoint} {status}'
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def sellable(self, part_id):
+        '''fixed share of loan parts can not be sold'''
+        digest = hashlib.md5(f'{self.seed}-{part_id}'.encode()).digest()
+        return digest[0] / 256 >= self.unsellable
+
+
+##############################################################################
+def page(items, query):
+    '''one page of items and the paging info'''
+    page_size = min(int(query.get('PageSize', [1000])[0]), MAX_PAGE_SIZE)
+    page_nr = max(int(query.get('PageNr', [1])[0]), 1)
+    start = (page_nr - 1) * page_size
+    return {'Payload': items[start:start+page_size],
+            'TotalCount': len(items),
+            'PageNr': page_nr,
+            'PageSize': page_size,
+            'Success': True,
+            'Errors': None}
+
+
+def error(code, message, details=None):
+    '''error entry of a response'''
+    return {'Code': code, 'Message': message, 'Details': details}
+
+
+##############################################################################
+class MockHandler(BaseHTTPRequestHandler):
+    '''request handler, the server holds the MockState'''
+    # keep connections alive for the pooled sessions
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, avoid waiting for the ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return None
+
+    def send_json(self, status, body, endpoint, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.state.count(endpoint, status)
+
+    def handle_api(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        endpoint = url.path[len(PREFIX):] if url.path.startswith(PREFIX) else url.path
+        body = {}
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+
+        if state.latency or state.jitter:
+            time.sleep(state.latency + random.uniform(0, state.jitter))
+
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if not token:
+            return self.send_json(401, {'Success': False,
+                                        'Errors': [error(401, 'Unauthorized')]}, endpoint)
+
+        route = ROUTES.get((method, endpoint))
+        if route is None:
+            return self.send_json(404, {'Success': False,
+                                        'Errors': [error(404, 'Not found', endpoint)]}, endpoint)
+
+        wait = state.throttled(token, endpoint)
+        if wait > 0:
+            return self.send_json(429, {'Success': False,
+                                        'Errors': [error(429, 'Too many requests')]},
+                                  endpoint, headers={'Retry-After': str(int(wait) + 1)})
+
+        status, response = route(state, state.account(token), parse_qs(url.query), body)
+        return self.send_json(status, response, endpoint)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+
+##############################################################################
+def get_balance(state, account, query, body):
+    return 200, {'Payload': {'Balance': account['balance'],
+                             'Reserved': 0,
+                             'BidRequestAmount': 0,
+                             'TotalAvailable': account['balance']},
+                 'Success': True, 'Errors': None}
+
+
+def get_investments(state, account, query, body):
+    with state.lock:
+        items = [item for item in account['investments'].values()
+                 if item['LoanPartId'] not in account['market']]
+    return 200, page(items, query)
+
+
+def get_secondarymarket(state, account, query, body):
+    with state.lock:
+        items = list(account['market'].values())
+    return 200, page(items, query)
+
+
+def post_sell(state, account, query, body):
+    items = body.get('Items') or []
+    if len(items) > MAX_ITEMS:
+        return 400, {'Success': False,
+                     'Errors': [error(400, f'At most {MAX_ITEMS} items per request')]}
+
+    with state.lock:
+        errors = [error(409, 'Investment can not be sold', item['LoanPartId'])
+                  for item in items
+                  if item['LoanPartId'] not in account['investments']
+                  or item['LoanPartId'] in account['market']
+                  or not state.sellable(item['LoanPartId'])]
+        # nothing is sold if one item fails
+        if errors:
+            return 409, {'Success': False, 'Errors': errors}
+
+        now = dt.datetime.now().strftime(TIME_FMT)
+        for item in items:
+            market_id = str(uuid.uuid4())
+            account['market'][item['LoanPartId']] = {
+                'Id': market_id,
+                'LoanPartId': item['LoanPartId'],
+                'DesiredDiscountRate': item['DesiredDiscountRate'],
+                'ListedOnDate': now}
+    return 202, {'Payload': None, 'Success': True, 'Errors': None}
+
+
+def post_cancel(state, account, query, body):
+    item_ids = set(body.get('ItemIds') or [])
+    with state.lock:
+        account['market'] = {part_id: item for part_id, item in account['market'].items()
+                             if item['Id'] not in item_ids}
+    return 202, {'Payload': None, 'Success': True, 'Errors': None}
+
+
+ROUTES = {('GET', 'account/balance'): get_balance,
+          ('GET', 'account/investments'): get_investments,
+          ('GET', 'secondarymarket'): get_secondarymarket,
+          ('POST', 'secondarymarket/sell'): post_sell,
+          ('POST', 'secondarymarket/cancel'): post_cancel}
+
+
+##############################################################################
+def start_server(state, host='localhost', port=0):
+    '''serve state in a background thread, returns server and base url'''
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, name='mockserver', daemon=True)
+    thread.start()
+    url = f'http://{host}:{server.server_address[1]}{PREFIX}'
+    return server, url
+
+
+##############################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--investments', type=int, default=1000,
+                        help='loan parts of every account')
+    parser.add_argument('--unsellable', type=float, default=0.05,
+                        help='share of loan parts that return 409')
+    parser.add_argument('--min-interval', type=float, default=0,
+                        help='seconds between requests of an account to an endpoint')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per response')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency')
+    args = parser.parse_args()
+
+    state = MockState(n_investments=args.investments, unsellable=args.unsellable,
+                      min_interval=args.min_interval, latency=args.latency,
+                      jitter=args.jitter)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    print(f'Serving on http://{args.host}:{args.port}{PREFIX}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(state.counts, indent=4, sort_keys=True))
+    return None
+
+
+if __name__ == '__main__':
+    main()
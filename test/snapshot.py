@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''Scripted check of the public dataset snapshot in functions/api.py
+
+Runs the base/delta/rebase flow of update_snapshot over several days on
+synthetic LoanData in a temporary directory:
+
+    day 1   first download          -> base
+    day 2   few changed loans       -> delta
+    day 2   many changed loans      -> rebase on the day of the base
+    day 2   many changed loans      -> rebase again
+    day 3   few changed and removed -> delta
+
+After every step read_publicdataset has to return the downloaded data,
+all files in snapshot.json have to exist and no other parquet files may
+be left. The real data folder is not touched.
+
+    python test/snapshot.py --rows 20000
+'''
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+basepath = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.join(basepath, '..')))
+
+from functions import api
+from functions.schema import apply_schema
+import synthetic
+
+
+##############################################################################
+def change_loans(data_raw, share, seed):
+    '''new interest for share of the loans'''
+    rng = np.random.RandomState(seed)
+    data_raw = data_raw.copy()
+    changed = rng.rand(len(data_raw)) < share
+    data_raw.loc[changed, 'Interest'] = data_raw.loc[changed, 'Interest'] + 1
+    return data_raw
+
+
+##############################################################################
+def check_step(name, data_raw, meta):
+    '''snapshot matches data_raw and holds exactly the files of meta'''
+    dir_name = api.publicdataset_dir()
+    files = [meta['base'], meta['base_hash']] + ([meta['delta']] if meta['delta'] else [])
+    missing = [f for f in files if not os.path.isfile(os.path.join(dir_name, f))]
+    left = sorted(set(os.path.basename(f) for f in glob.glob(os.path.join(dir_name, '*.parquet')))
+                  - set(files))
+    assert not missing, f'{name}: missing {missing}'
+    assert not left, f'{name}: files left {left}'
+
+    expected = data_raw.sort_values('LoanId').reset_index(drop=True)
+    result = api.read_publicdataset().sort_values('LoanId').reset_index(drop=True)
+    pd.testing.assert_frame_equal(result[expected.columns], expected,
+                                  check_dtype=False, check_categorical=False)
+    print(f'{name:<32} ok | {", ".join(files)}')
+    return None
+
+
+##############################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=20_000, help='credits of the dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs(api.publicdataset_dir())
+
+    data_raw = apply_schema(synthetic.public_dataset(args.rows, seed=args.seed))
+    steps = [('day 1 base', '2020_01_01', 0),
+             ('day 2 delta', '2020_01_02', 0.05),
+             ('day 2 rebase', '2020_01_02', 0.5),
+             ('day 2 rebase again', '2020_01_02', 0.5),
+             ('day 3 delta with removed loans', '2020_01_03', 0.05)]
+    meta = {}
+    for nr, (name, today, share) in enumerate(steps):
+        data_raw = change_loans(data_raw, share, args.seed + nr)
+        if name.endswith('removed loans'):
+            data_raw = data_raw.iloc[10:]
+        meta = api.update_snapshot(data_raw, meta, today=today)
+        check_step(name, data_raw, meta)
+    print('Snapshot flow ok')
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''Synthetic LoanData for benchmarks
+
+public_dataset builds a frame shaped like the public LoanData csv after
+parsing (same columns, value ranges, categories and missing values).
+Defaults depend on rating, interest and income, so the random forest has
+something to learn. investments and current_sales build the user side
+for pick_items and the sales manager.
+'''
+
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+RATINGS = ['AA', 'A', 'B', 'C', 'D', 'E', 'F', 'HR']
+# default rate of each rating
+RATING_DEFAULT = [0.02, 0.04, 0.07, 0.11, 0.16, 0.23, 0.32, 0.45]
+COUNTRIES = ['EE', 'FI', 'ES', 'SK']
+COUNTRY_SHARE = [0.45, 0.25, 0.25, 0.05]
+LATE_CATEGORIES = ['1-7', '8-15', '16-30', '31-60', '61-90', '91-120',
+                   '121-150', '151-180']
+EMPLOYMENT = ['MoreThan5Years', 'UpTo1Year', 'UpTo2Years', 'UpTo3Years',
+              'UpTo4Years', 'UpTo5Years', 'TrialPeriod', 'Retiree', 'Other']
+# share of missing values per column
+MISSING = {'AmountOfPreviousLoansBeforeLoan': 0.35,
+           'Education': 0.02,
+           'Gender': 0.02,
+           'MonthlyPayment': 0.05,
+           'NoOfPreviousLoansBeforeLoan': 0.01,
+           'PreviousRepaymentsBeforeLoan': 0.35,
+           'VerificationType': 0.01}
+
+
+##############################################################################
+def public_dataset(n_rows, seed=0, start='2012-01-01'):
+    '''public LoanData with n_rows credits'''
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp(start)
+    days = (pd.Timestamp(dt.date.today()) - start).days
+
+    # later credits are more frequent
+    bidding = start + pd.to_timedelta(np.sort(days * np.sqrt(rng.rand(n_rows))), unit='D')
+    rating = rng.choice(len(RATINGS), n_rows, p=[0.05, 0.1, 0.15, 0.2, 0.2, 0.15, 0.1, 0.05])
+    applied = np.round(rng.lognormal(7.5, 0.8, n_rows), -1).clip(50, 10_630)
+    amount = np.round(applied * rng.uniform(0.5, 1, n_rows), 2)
+    duration = rng.choice([6, 9, 12, 18, 24, 36, 48, 60], n_rows)
+    interest = np.round(8 + rating * 10 + rng.gamma(2, 4, n_rows), 2).clip(6, 264)
+    income = np.round(rng.lognormal(6.8, 0.6, n_rows), 0)
+    monthly = np.round(amount * (interest / 1200) / (1 - (1 + interest / 1200) ** -duration), 2)
+    previous = rng.poisson(1.2, n_rows)
+
+    data = pd.DataFrame({
+        'LoanId': [f'{i:012x}' for i in rng.permutation(n_rows)],
+        'BiddingStartedOn': bidding,
+        'Age': rng.randint(18, 75, n_rows),
+        'Amount': amount,
+        'AmountOfPreviousLoansBeforeLoan': np.round(previous * rng.lognormal(7, 0.7, n_rows), 2),
+        'AppliedAmount': applied,
+        'BidsApi': np.round(amount * rng.beta(1, 3, n_rows), 0),
+        'BidsManual': np.round(amount * rng.beta(1, 8, n_rows), 0),
+        'BidsPortfolioManager': np.round(amount * rng.beta(3, 2, n_rows), 0),
+        'Country': rng.choice(COUNTRIES, n_rows, p=COUNTRY_SHARE),
+        'Education': rng.choice([-1, 1, 2, 3, 4, 5], n_rows, p=[0.01, 0.09, 0.2, 0.4, 0.1, 0.2]).astype(float),
+        'EmploymentDurationCurrentEmployer': rng.choice(EMPLOYMENT, n_rows),
+        'ExistingLiabilities': rng.poisson(3, n_rows),
+        'Gender': rng.choice([0, 1, 2], n_rows, p=[0.6, 0.35, 0.05]).astype(float),
+        'IncomeTotal': income,
+        'Interest': interest,
+        'LiabilitiesTotal': np.round(income * rng.beta(2, 5, n_rows), 2),
+        'LoanDuration': duration,
+        'MonthlyPayment': monthly,
+        'NewCreditCustomer': previous == 0,
+        'NoOfPreviousLoansBeforeLoan': previous.astype(float),
+        'PreviousRepaymentsBeforeLoan': np.round(previous * rng.lognormal(6, 0.8, n_rows), 2),
+        'ProbabilityOfDefault': np.round(np.array(RATING_DEFAULT)[rating] * rng.uniform(0.7, 1.3, n_rows), 4),
+        'Rating': np.array(RATINGS)[rating],
+        'Status': rng.choice(['Current', 'Late', 'Repaid'], n_rows, p=[0.5, 0.2, 0.3]),
+        'VerificationType': rng.choice([1, 2, 3, 4], n_rows, p=[0.3, 0.1, 0.1, 0.5]).astype(float),
+        })
+
+    # default depends on rating, interest burden and previous loans
+    risk = (np.array(RATING_DEFAULT)[rating]
+            * (1 + (monthly / income).clip(0, 2))
+            * np.where(previous == 0, 1.3, 0.9))
+    defaulted = rng.rand(n_rows) < risk
+    late = rng.rand(n_rows) < 0.3
+    worse_late = np.full(n_rows, None, dtype=object)
+    worse_late[late] = rng.choice(LATE_CATEGORIES, late.sum())
+    worse_late[defaulted] = '180+'
+    data['WorseLateCategory'] = worse_late
+
+    for col, share in MISSING.items():
+        data.loc[rng.rand(n_rows) < share, col] = np.nan
+    return data
+
+
+##############################################################################
+def investments(public, n_rows, seed=0):
+    '''user investments in n_rows credits of public as saved by save_investments'''
+    rng = np.random.RandomState(seed)
+    rows = rng.choice(len(public), min(n_rows, len(public)), replace=False)
+    data = public.iloc[rows].reset_index(drop=True)
+
+    now = pd.Timestamp(dt.datetime.now())
+    listed = rng.rand(len(data)) < 0.1
+    data['LoanPartId'] = [f'part-{i:010d}' for i in rng.permutation(len(data))]
+    data['ListedInSecondMarketOn'] = pd.NaT
+    data.loc[listed, 'ListedInSecondMarketOn'] = now - pd.to_timedelta(rng.randint(0, 72, listed.sum()), unit='h')
+    data['NextPaymentNr'] = rng.randint(1, 4, len(data))
+    return data
+
+
+##############################################################################
+def current_sales(n_rows, seed=0):
+    '''items on sale as returned by check_sales'''
+    rng = np.random.RandomState(seed)
+    now = pd.Timestamp(dt.datetime.now())
+    data = pd.DataFrame({
+        'Date': now - pd.to_timedelta(rng.randint(0, 6 * 3600, n_rows), unit='s'),
+        'LoanPartId': [f'part-{i:010d}' for i in rng.randint(0, 2**31, n_rows)],
+        'Gain': rng.randint(0, 6, n_rows),
+        'MarketId': [f'market-{i:010d}' for i in rng.randint(0, 2**31, n_rows)]})
+    return data